@@ -0,0 +1,31 @@
+from spc.spc import SPC
+from spc.buzzer import BuzzerSequencer
+import time
+
+spc = SPC()
+
+C4 = 262
+E4 = 330
+G4 = 392
+A4 = 440
+
+chime = [(E4, 0.1, 3), (A4, 0.1)]
+alarm = [(G4, 0.1, 8), (0, 0.1)] * 5
+
+def main():
+    with BuzzerSequencer(spc) as buzzer:
+        # play() returns at once, the loop keeps running while the melody plays
+        melody = buzzer.play(chime * 5)
+        for i in range(5):
+            print(f"Battery: {spc.read_battery_percentage()} %")
+            time.sleep(0.1)
+        # Higher priority cuts the chime off
+        buzzer.play(alarm, priority=10).wait()
+        print(f"Chime completed: {melody.completed}")
+        buzzer.play([(C4, 0.5)]).wait()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,93 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from .spc import SPC
+
+
+class AsyncSPC():
+    '''
+    asyncio client with the SPC API as coroutines.
+
+    Bus access runs on a single worker thread, and calls are serialized with
+    an asyncio lock, so the event loop never blocks on the bus.
+
+    spc = await AsyncSPC.create()
+    data = await spc.read_all()
+    await spc.buzzer_play_tone(440, 0.5)
+    '''
+    def __init__(self, spc, executor=None):
+        '''
+        spc, SPC object
+        executor, executor running the bus access, default a single worker thread
+        '''
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spc')
+        self.spc = spc
+        self.device = spc.device
+        self._executor = executor
+        # Created on first use, asyncio.Lock binds to the running loop before Python 3.10
+        self._lock = None
+        self._buzzer_lock = None
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        '''
+        Create the SPC object on the worker thread, arguments are passed to SPC.
+        '''
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spc')
+        loop = asyncio.get_running_loop()
+        spc = await loop.run_in_executor(executor, functools.partial(SPC, *args, **kwargs))
+        return cls(spc, executor)
+
+    async def _call(self, name, *args, **kwargs):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        func = functools.partial(getattr(self.spc, name), *args, **kwargs)
+        async with self._lock:
+            return await loop.run_in_executor(self._executor, func)
+
+    def is_ready(self):
+        return self.spc.is_ready()
+
+    async def buzzer_play_tone(self, tone, duration):
+        '''
+        tone, int, frequency of the tone
+        duration, float, duration of the tone in seconds
+
+        The bus is free while the tone plays, tones from several tasks play one after another.
+        '''
+        if 'buzzer' not in self.device.peripherals:
+            raise ValueError(f"Buzzer not supported for {self.device.name}")
+        if self._buzzer_lock is None:
+            self._buzzer_lock = asyncio.Lock()
+        async with self._buzzer_lock:
+            await self.write_buzzer_freq(tone)
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                await self.write_buzzer_freq(0)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _coroutine(name):
+    async def method(self, *args, **kwargs):
+        return await self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = f'AsyncSPC.{name}'
+    method.__doc__ = getattr(SPC, name).__doc__
+    return method
+
+
+for _name in dir(SPC):
+    if _name.startswith('read_') or _name.startswith('write_') or _name in ('set_buzzer_volume', 'get_buzzer_volume'):
+        setattr(AsyncSPC, _name, _coroutine(_name))
@@ -0,0 +1,286 @@
+import math
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _get(data, name, default=None):
+    # read_all() dicts and Reading namedtuples
+    if isinstance(data, dict):
+        return data.get(name, default)
+    return getattr(data, name, default)
+
+
+def integrate(timestamps, voltages, currents):
+    '''
+    Integrate a history with the trapezoidal rule, vectorized with NumPy if
+    it is installed.
+
+    timestamps, seconds; voltages, mV; currents, mA, negative when discharging
+
+    Return (charged Wh, discharged Wh, charged mAh, discharged mAh).
+    '''
+    if len(timestamps) < 2:
+        return 0.0, 0.0, 0.0, 0.0
+    if numpy is not None:
+        t = numpy.asarray(timestamps, dtype=float)
+        v = numpy.asarray(voltages, dtype=float)
+        i = numpy.asarray(currents, dtype=float)
+        hours = numpy.diff(t) / 3600
+        power = v * i / 1e6
+        energy = (power[1:] + power[:-1]) / 2 * hours
+        charge = (i[1:] + i[:-1]) / 2 * hours
+        return (float(energy[energy > 0].sum()), float(-energy[energy < 0].sum()),
+                float(charge[charge > 0].sum()), float(-charge[charge < 0].sum()))
+    charged_wh = discharged_wh = charged_mah = discharged_mah = 0.0
+    for k in range(1, len(timestamps)):
+        hours = (timestamps[k] - timestamps[k - 1]) / 3600
+        energy = (voltages[k] * currents[k] + voltages[k - 1] * currents[k - 1]) / 2e6 * hours
+        charge = (currents[k] + currents[k - 1]) / 2 * hours
+        if energy > 0:
+            charged_wh += energy
+        else:
+            discharged_wh -= energy
+        if charge > 0:
+            charged_mah += charge
+        else:
+            discharged_mah -= charge
+    return charged_wh, discharged_wh, charged_mah, discharged_mah
+
+
+class BatteryAnalytics():
+    '''
+    Battery energy, cycles and runtime estimates from read_all() samples,
+    updated in constant time per sample.
+
+    - energy in and out in Wh and charge in mAh, trapezoidal integration of
+      battery_voltage x battery_current
+    - equivalent full cycles, discharged mAh / capacity, and the number of
+      charge and discharge sessions
+    - time to empty and time to full from the remaining charge and the
+      battery current averaged over window seconds
+
+    The remaining charge is capacity x battery_percentage. While discharging
+    it is reduced by the internal resistance: the device shuts down when the
+    voltage under load, open circuit voltage - current x resistance, reaches
+    empty_voltage, so part of the charge is never available. The open circuit
+    voltage is assumed to fall linearly with the charge.
+
+    analytics = BatteryAnalytics.from_spc(spc)
+    analytics.update(spc.read_all())
+    print(analytics.time_to_empty)
+    '''
+    IDLE = 'idle'
+    CHARGING = 'charging'
+    DISCHARGING = 'discharging'
+
+    # Empty voltage per cell, mV, and the nominal cell voltage to count cells
+    CELL_EMPTY_VOLTAGE = 3000
+    CELL_NOMINAL_VOLTAGE = 3700
+
+    def __init__(self, capacity=None, internal_resistance=None, empty_voltage=None, window=60.0, idle_current=50):
+        '''
+        capacity, int, mAh, full battery capacity, default the battery_capacity field if the device has it
+        internal_resistance, int, mOhm, battery internal resistance, None to not correct for it
+        empty_voltage, int, mV, battery voltage under load at which the device shuts down,
+            default CELL_EMPTY_VOLTAGE per cell
+        window, float, seconds the battery current is averaged over
+        idle_current, int, mA, currents this small count as neither charging nor discharging
+        '''
+        self.capacity = capacity
+        self.internal_resistance = internal_resistance
+        self.empty_voltage = empty_voltage
+        self.window = window
+        self.idle_current = idle_current
+
+        self.charged_wh = 0.0
+        self.discharged_wh = 0.0
+        self.charged_mah = 0.0
+        self.discharged_mah = 0.0
+        self.charge_sessions = 0
+        self.discharge_sessions = 0
+        self.state = self.IDLE
+        self.samples = 0
+        self.average_current = None
+        self.voltage = None
+        self.percentage = None
+        self._last = None
+
+    @classmethod
+    def from_spc(cls, spc, **kwargs):
+        '''
+        Create analytics for an SPC device, taking the internal resistance
+        from its battery_ir register unless given.
+        '''
+        if 'internal_resistance' not in kwargs:
+            battery_ir = spc.read_extended().get('battery_ir')
+            if battery_ir:
+                kwargs['internal_resistance'] = battery_ir
+        return cls(**kwargs)
+
+    def update(self, data, timestamp=None):
+        '''
+        Add a read_all() result or Reading. Samples without battery current,
+        e.g. from PiPower 3, only update the percentage.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        voltage = _get(data, 'battery_voltage')
+        current = _get(data, 'battery_current')
+        self.percentage = _get(data, 'battery_percentage', self.percentage)
+        capacity = _get(data, 'battery_capacity')
+        if self.capacity is None and capacity:
+            self.capacity = capacity
+        if voltage is None or current is None:
+            return
+        self.voltage = voltage
+        self.samples += 1
+
+        if self._last is not None:
+            last_timestamp, last_voltage, last_current = self._last
+            seconds = timestamp - last_timestamp
+            if seconds > 0:
+                hours = seconds / 3600
+                energy = (voltage * current + last_voltage * last_current) / 2e6 * hours
+                charge = (current + last_current) / 2 * hours
+                if energy > 0:
+                    self.charged_wh += energy
+                else:
+                    self.discharged_wh -= energy
+                if charge > 0:
+                    self.charged_mah += charge
+                else:
+                    self.discharged_mah -= charge
+                # Exponential moving average with a time constant of window
+                alpha = 1 - math.exp(-seconds / self.window)
+                self.average_current += alpha * (current - self.average_current)
+        else:
+            self.average_current = current
+        self._last = (timestamp, voltage, current)
+
+        state = self._classify(current)
+        if state != self.state:
+            if state == self.CHARGING:
+                self.charge_sessions += 1
+            elif state == self.DISCHARGING:
+                self.discharge_sessions += 1
+            self.state = state
+
+    def _classify(self, current):
+        if current >= self.idle_current:
+            return self.CHARGING
+        if current <= -self.idle_current:
+            return self.DISCHARGING
+        return self.IDLE
+
+    def update_many(self, timestamps, voltages, currents, percentage=None, capacity=None):
+        '''
+        Add a history by columns in one vectorized step, e.g. from a
+        ReadingBatch or Poller.window(). Sessions are not counted.
+        '''
+        if len(timestamps) == 0:
+            return
+        if self._last is not None:
+            timestamps = [self._last[0]] + list(timestamps)
+            voltages = [self._last[1]] + list(voltages)
+            currents = [self._last[2]] + list(currents)
+        charged_wh, discharged_wh, charged_mah, discharged_mah = integrate(timestamps, voltages, currents)
+        self.charged_wh += charged_wh
+        self.discharged_wh += discharged_wh
+        self.charged_mah += charged_mah
+        self.discharged_mah += discharged_mah
+        self.samples += len(timestamps) - (self._last is not None)
+        if percentage is not None:
+            self.percentage = percentage
+        if self.capacity is None and capacity:
+            self.capacity = capacity
+        # Average the current over the last window seconds
+        end = timestamps[-1]
+        recent = [current for timestamp, current in zip(timestamps, currents) if end - timestamp <= self.window]
+        self.average_current = sum(recent) / len(recent)
+        self.voltage = voltages[-1]
+        self.state = self._classify(currents[-1])
+        self._last = (timestamps[-1], voltages[-1], currents[-1])
+
+    @property
+    def cycles(self):
+        '''
+        Equivalent full discharge cycles, None without a capacity.
+        '''
+        if not self.capacity:
+            return None
+        return self.discharged_mah / self.capacity
+
+    @property
+    def remaining_mah(self):
+        if not self.capacity or self.percentage is None:
+            return None
+        return self.capacity * self.percentage / 100
+
+    def _empty_voltage(self):
+        if self.empty_voltage is not None:
+            return self.empty_voltage
+        cells = max(1, round(self.voltage / self.CELL_NOMINAL_VOLTAGE))
+        return cells * self.CELL_EMPTY_VOLTAGE
+
+    @property
+    def usable_mah(self):
+        '''
+        Remaining charge the device can use at the average current, None if unknown.
+        '''
+        remaining = self.remaining_mah
+        if remaining is None:
+            return None
+        if not self.internal_resistance or self.average_current is None or self.average_current >= 0:
+            return remaining
+        drop = -self.average_current * self.internal_resistance / 1000
+        open_circuit = self.voltage + drop
+        span = open_circuit - self._empty_voltage()
+        if span <= 0:
+            return 0.0
+        return remaining * max(0.0, 1 - drop / span)
+
+    @property
+    def time_to_empty(self):
+        '''
+        Seconds until the battery is empty at the average current, None unless discharging.
+        '''
+        if self.state != self.DISCHARGING or not self.average_current or self.average_current >= 0:
+            return None
+        usable = self.usable_mah
+        if usable is None:
+            return None
+        return usable / -self.average_current * 3600
+
+    @property
+    def time_to_full(self):
+        '''
+        Seconds until the battery is full at the average current, None unless charging.
+        The current drops near the end of a charge, so this is a lower bound.
+        '''
+        if self.state != self.CHARGING or not self.average_current or self.average_current <= 0:
+            return None
+        remaining = self.remaining_mah
+        if remaining is None:
+            return None
+        return max(0.0, self.capacity - remaining) / self.average_current * 3600
+
+    def summary(self):
+        return {
+            'state': self.state,
+            'charged_wh': self.charged_wh,
+            'discharged_wh': self.discharged_wh,
+            'charged_mah': self.charged_mah,
+            'discharged_mah': self.discharged_mah,
+            'cycles': self.cycles,
+            'charge_sessions': self.charge_sessions,
+            'discharge_sessions': self.discharge_sessions,
+            'average_current': self.average_current,
+            'remaining_mah': self.remaining_mah,
+            'usable_mah': self.usable_mah,
+            'time_to_empty': self.time_to_empty,
+            'time_to_full': self.time_to_full,
+        }
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+'''
+Benchmark every read_*/write_* method of SPC against the simulated bus.
+
+Reports wall time, bus transactions and bytes moved per call, for each
+device profile and I2C mode, as JSON. Two reports can be compared to catch
+regressions:
+
+    python3 -m spc.benchmark -o baseline.json
+    python3 -m spc.benchmark --compare baseline.json
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+
+from .devices import Devices
+from .i2c import I2C
+from .simulator import SimulatedDevice, SimulatedSMBus
+from .spc import SPC
+from .version import __version__
+
+# Arguments used to call write methods, methods not listed here are skipped
+WRITE_ARGS = {
+    'write_fan_power': lambda: (50,),
+    'write_shutdown_percentage': lambda: (20,),
+    'write_power_off_percentage': lambda: (10,),
+    'write_rtc': lambda: ([24, 1, 1, 12, 0, 0, 0],),
+    'write_power_btn_state': lambda: (0,),
+    'write_buzzer_volume': lambda: (5,),
+    'write_buzzer_freq': lambda: (440,),
+}
+
+MODES = ('normal', 'esp32')
+
+
+class RecordingSMBus():
+    '''
+    Wrap an SMBus like object and count transactions and bytes moved.
+    '''
+    def __init__(self, smbus):
+        self._smbus = smbus
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _record(self, read=0, written=0):
+        self.transactions += 1
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def read_byte(self, i2c_addr, force=None):
+        self._record(read=1)
+        return self._smbus.read_byte(i2c_addr, force=force)
+
+    def write_byte(self, i2c_addr, value, force=None):
+        self._record(written=1)
+        return self._smbus.write_byte(i2c_addr, value, force=force)
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        self._record(read=1, written=1)
+        return self._smbus.read_byte_data(i2c_addr, register, force=force)
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self._record(written=2)
+        return self._smbus.write_byte_data(i2c_addr, register, value, force=force)
+
+    def read_word_data(self, i2c_addr, register, force=None):
+        self._record(read=2, written=1)
+        return self._smbus.read_word_data(i2c_addr, register, force=force)
+
+    def write_word_data(self, i2c_addr, register, value, force=None):
+        self._record(written=3)
+        return self._smbus.write_word_data(i2c_addr, register, value, force=force)
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        self._record(read=length, written=1)
+        return self._smbus.read_i2c_block_data(i2c_addr, register, length, force=force)
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self._record(written=1 + len(data))
+        return self._smbus.write_i2c_block_data(i2c_addr, register, data, force=force)
+
+    def i2c_rdwr(self, *i2c_msgs):
+        read = sum(msg.len for msg in i2c_msgs if msg.flags & 0x0001)
+        written = sum(msg.len for msg in i2c_msgs if not msg.flags & 0x0001)
+        self._record(read=read, written=written)
+        return self._smbus.i2c_rdwr(*i2c_msgs)
+
+    def close(self):
+        return self._smbus.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def methods():
+    names = [name for name in dir(SPC) if name.startswith('read_') or name.startswith('write_')]
+    return sorted(names)
+
+
+def measure(bus, func, args_factory=tuple, iterations=100):
+    '''
+    Call func iterations times, return per call median time and bus usage.
+    '''
+    times = []
+    bus.reset()
+    for _ in range(iterations):
+        args = args_factory()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        'time_us': round(times[len(times)//2] * 1e6, 2),
+        'transactions': bus.transactions / iterations,
+        'bytes_read': bus.bytes_read / iterations,
+        'bytes_written': bus.bytes_written / iterations,
+    }
+
+
+def example_read_all_loop(spc):
+    '''
+    Bus access of one iteration of example/read_all.py
+    '''
+    spc.read_all()
+    spc.read_board_id()
+    if 'default_on' in spc.device.peripherals:
+        spc.read_default_on()
+    if 'shutdown_percentage' in spc.device.peripherals:
+        spc.read_shutdown_percentage()
+    if 'power_off_percentage' in spc.device.peripherals:
+        spc.read_power_off_percentage()
+
+
+def benchmark_device(address, mode, iterations=100, latency=0):
+    device = SimulatedDevice(address, mode=mode)
+    bus = RecordingSMBus(SimulatedSMBus(device, latency=latency))
+    spc = SPC(smbus=bus, address=address)
+    spc.i2c = I2C(address, mode=mode, smbus=bus)
+
+    results = {}
+    for name in methods():
+        func = getattr(spc, name)
+        if name.startswith('write_'):
+            if name not in WRITE_ARGS:
+                continue
+            args_factory = WRITE_ARGS[name]
+        else:
+            args_factory = tuple
+        try:
+            func(*args_factory())
+        except ValueError:
+            # Not supported by this device
+            continue
+        results[name] = measure(bus, func, args_factory, iterations)
+
+    scenarios = {}
+    scenarios['example_read_all'] = measure(bus, example_read_all_loop, lambda: (spc,), iterations)
+    scenarios['example_read_all']['extra_transactions'] = \
+        scenarios['example_read_all']['transactions'] - results['read_all']['transactions']
+
+    return {
+        'device': spc.device.id,
+        'name': spc.device.name,
+        'address': f'0x{address:02X}',
+        'mode': mode,
+        'methods': results,
+        'scenarios': scenarios,
+    }
+
+
+def run(addresses=Devices.ADDRESS, iterations=100, latency=0, all_modes=False):
+    report = {
+        'spc_version': __version__,
+        'python': platform.python_version(),
+        'iterations': iterations,
+        'latency': latency,
+        'results': {},
+    }
+    for address in addresses:
+        profile_mode = Devices.DEVICES[address]['mode']
+        modes = MODES if all_modes else (profile_mode, )
+        for mode in modes:
+            result = benchmark_device(address, mode, iterations, latency)
+            report['results'][f"{result['device']}/{mode}"] = result
+    return report
+
+
+def compare(baseline, current, threshold=None):
+    '''
+    Compare two reports, return a list of regression messages.
+
+    Any increase of transactions or bytes moved is a regression. Wall time is
+    noisy, so it is only compared if threshold is given, and is a regression
+    if it grows by more than threshold (0.5 = 50%).
+    '''
+    regressions = []
+    for key, result in current['results'].items():
+        if key not in baseline['results']:
+            continue
+        base_result = baseline['results'][key]
+        for group in ('methods', 'scenarios'):
+            for name, stats in result[group].items():
+                base = base_result[group].get(name)
+                if base is None:
+                    continue
+                for field in ('transactions', 'bytes_read', 'bytes_written'):
+                    if stats[field] > base[field]:
+                        regressions.append(f"{key} {name}: {field} {base[field]} -> {stats[field]}")
+                if threshold is not None and base['time_us'] > 0 and stats['time_us'] > base['time_us'] * (1 + threshold):
+                    regressions.append(f"{key} {name}: time_us {base['time_us']} -> {stats['time_us']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SPC methods against the simulated bus')
+    parser.add_argument('-n', '--iterations', type=int, default=100, help='calls per method')
+    parser.add_argument('--latency', type=float, default=0, help='simulated seconds per bus transaction')
+    parser.add_argument('--all-modes', action='store_true', help='run every device profile in both normal and esp32 mode')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=None, help='allowed relative time increase when comparing, time is not compared if not given')
+    args = parser.parse_args()
+
+    report = run(iterations=args.iterations, latency=args.latency, all_modes=args.all_modes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
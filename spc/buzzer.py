@@ -0,0 +1,237 @@
+from collections import namedtuple
+import heapq
+import itertools
+import threading
+import time
+
+
+class Step(namedtuple('Step', ['frequency', 'duration', 'volume'])):
+    '''
+    frequency, int, Hz, 0 for a rest
+    duration, float, seconds
+    volume, int, 0-10, None to keep the current volume
+    '''
+    __slots__ = ()
+
+    def __new__(cls, frequency, duration, volume=None):
+        return super().__new__(cls, frequency, duration, volume)
+
+
+class Melody():
+    '''
+    A queued list of steps, returned by BuzzerSequencer.play().
+    '''
+    def __init__(self, sequencer, steps, priority):
+        self.steps = tuple(Step(*step) for step in steps)
+        self.priority = priority
+        # True once played to the end, False if cancelled or preempted
+        self.completed = None
+        self.cancelled = False
+        self._sequencer = sequencer
+        self._done = threading.Event()
+
+    def _finish(self, completed):
+        self.completed = completed
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until the melody ended, return False on timeout.
+        '''
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        self._sequencer._cancel(self)
+
+
+class BuzzerSequencer():
+    '''
+    Play melodies on the buzzer from a background thread, play() returns at once.
+
+    Melodies play one after another in order of priority, then of arrival. A
+    melody with a higher priority than the playing one cuts it off. Step times
+    are kept on an absolute schedule, so bus latency does not add up over a
+    melody. The frequency and volume registers are only written when they
+    change.
+
+    buzzer = BuzzerSequencer(spc)
+    buzzer.start()
+    chime = buzzer.play([(659, 0.1), (880, 0.1)])
+    buzzer.play([(392, 0.1), (0, 0.1)] * 5, priority=10)  # cuts the chime off
+    '''
+    # Seconds before retrying to silence the buzzer after a failed write
+    RETRY_DELAY = 0.5
+
+    def __init__(self, spc, get_logger=None):
+        '''
+        spc, SPC object of a device with a buzzer
+        '''
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        if 'buzzer' not in spc.device.peripherals:
+            raise ValueError(f"Buzzer not supported for {spc.device.name}")
+        self.spc = spc
+        self.writes = 0
+        self._frequency = None
+        self._volume = None
+        self._retry_at = 0.0
+        self._queue = []
+        self._order = itertools.count()
+        self._current = None
+        self._index = 0
+        self._step_end = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def play(self, steps, priority=0, interrupt=False):
+        '''
+        Queue a melody, return its Melody.
+
+        steps, list of (frequency, duration) or (frequency, duration, volume)
+        priority, int, higher plays first and cuts off lower ones
+        interrupt, bool, cancel everything playing or queued first
+        '''
+        melody = Melody(self, steps, priority)
+        with self._cond:
+            if interrupt:
+                self._cancel_all()
+            heapq.heappush(self._queue, (-priority, next(self._order), melody))
+            self._cond.notify()
+        return melody
+
+    def play_tone(self, frequency, duration, volume=None, priority=0, interrupt=False):
+        return self.play([(frequency, duration, volume)], priority, interrupt)
+
+    def _cancel(self, melody):
+        with self._cond:
+            melody.cancelled = True
+            # A queued melody ends at once, the playing one when the thread wakes up
+            queue = [item for item in self._queue if item[2] is not melody]
+            if len(queue) < len(self._queue):
+                heapq.heapify(queue)
+                self._queue = queue
+                melody._finish(False)
+            self._cond.notify()
+
+    def _cancel_all(self):
+        for _, _, melody in self._queue:
+            melody.cancelled = True
+            melody._finish(False)
+        self._queue.clear()
+        if self._current is not None:
+            self._current.cancelled = True
+
+    def stop_all(self):
+        '''
+        Cancel every melody, the buzzer goes quiet.
+        '''
+        with self._cond:
+            self._cancel_all()
+            self._cond.notify()
+
+    def _next_step(self, now):
+        # Called holding _cond, return the step to play now, None to wait
+        while self._queue and self._queue[0][2].cancelled:
+            heapq.heappop(self._queue)[2]._finish(False)
+        if self._current is not None and self._current.cancelled:
+            self._current._finish(False)
+            self._current = None
+        if self._queue and (self._current is None or -self._queue[0][0] > self._current.priority):
+            if self._current is not None:
+                self.log.debug('BuzzerSequencer: melody preempted')
+                self._current._finish(False)
+            self._current = heapq.heappop(self._queue)[2]
+            self._index = 0
+            self._step_end = now
+        while self._current is not None and now >= self._step_end:
+            if self._index < len(self._current.steps):
+                step = self._current.steps[self._index]
+                self._index += 1
+                # Keep to the schedule unless more than a step late
+                if now - self._step_end > step.duration:
+                    self._step_end = now
+                self._step_end += step.duration
+                return step
+            self._current._finish(True)
+            self._current = None
+            if self._queue:
+                return self._next_step(now)
+        if self._current is None and self._frequency != 0 and now >= self._retry_at:
+            return Step(0, 0)
+        return None
+
+    def _wait_time(self, now):
+        if self._current is None:
+            if self._frequency != 0:
+                # Silencing failed, retry later
+                return max(0, self._retry_at - now)
+            return None
+        return max(0, self._step_end - now)
+
+    def _apply(self, step):
+        try:
+            if step.volume is not None and step.volume != self._volume:
+                self._volume = None
+                self.spc.write_buzzer_volume(step.volume)
+                self._volume = step.volume
+                self.writes += 1
+            if step.frequency != self._frequency:
+                self._frequency = None
+                self.spc.write_buzzer_freq(step.frequency)
+                self._frequency = step.frequency
+                self.writes += 1
+        except OSError as e:
+            self.log.warning(f'BuzzerSequencer write error: {e}')
+            self._retry_at = time.monotonic() + self.RETRY_DELAY
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        self._cancel_all()
+                        self._next_step(time.monotonic())
+                        break
+                    now = time.monotonic()
+                    step = self._next_step(now)
+                    if step is not None:
+                        break
+                    self._cond.wait(self._wait_time(now))
+            if self._stopping:
+                self._apply(Step(0, 0))
+                return
+            self._apply(step)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='spc-buzzer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Cancel every melody, silence the buzzer and stop the thread.
+        '''
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
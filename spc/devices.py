@@ -72,4 +72,4 @@ class Devices():
         self.id = self.device['id']
         self.address = self.device['address']
         self.mode = self.device['mode']
-        self.peripherals = self.device['peripherals']
+        self.peripherals = frozenset(self.device['peripherals'])
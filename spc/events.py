@@ -0,0 +1,262 @@
+from collections import namedtuple
+import queue
+import threading
+import time
+
+from .poller import Poller
+from .spc import SPC
+
+
+class Event(namedtuple('Event', ['type', 'field', 'value', 'previous', 'timestamp'])):
+    __slots__ = ()
+
+
+class EventMonitor():
+    '''
+    Turn consecutive read_all() snapshots into power state change events.
+
+    One poll serves every subscriber. The snapshots come from a Poller, its
+    own or one shared with other consumers. A field change is reported once
+    it has been seen in debounce consecutive snapshots.
+
+    The latched power button state is reported as soon as it is read. The
+    device keeps a final state (click, double click, long press released)
+    until it is written back, so a repeat of the same press is not seen. With
+    reset_button the monitor writes the state back to released after
+    reporting it, which also clears it for every other reader of the device.
+
+    monitor = EventMonitor(spc, interval=0.5)
+    monitor.subscribe(print, types=[EventMonitor.INPUT_UNPLUGGED])
+    monitor.start()
+    for event in monitor.events():
+        print(event.type)
+    '''
+    INPUT_PLUGGED_IN = 'input_plugged_in'
+    INPUT_UNPLUGGED = 'input_unplugged'
+    CHARGING_STARTED = 'charging_started'
+    CHARGING_STOPPED = 'charging_stopped'
+    POWER_SOURCE_EXTERNAL = 'power_source_external'
+    POWER_SOURCE_BATTERY = 'power_source_battery'
+    SHUTDOWN_REQUEST_CLEARED = 'shutdown_request_cleared'
+    SHUTDOWN_REQUEST_LOW_BATTERY = 'shutdown_request_low_battery'
+    SHUTDOWN_REQUEST_BUTTON = 'shutdown_request_button'
+    SHUTDOWN_REQUEST_LOW_BATTERY_VOLTAGE = 'shutdown_request_low_battery_voltage'
+    BUTTON_RELEASED = 'button_released'
+    BUTTON_SINGLE_CLICKED = 'button_single_clicked'
+    BUTTON_DOUBLE_CLICKED = 'button_double_clicked'
+    BUTTON_LONG_PRESSED_2S = 'button_long_pressed_2s'
+    BUTTON_LONG_PRESSED_2S_RELEASED = 'button_long_pressed_2s_released'
+    BUTTON_LONG_PRESSED_5S = 'button_long_pressed_5s'
+    BUTTON_LONG_PRESSED_5S_RELEASED = 'button_long_pressed_5s_released'
+
+    # field: {new value: event type}, other values give '<field>_changed'
+    FIELD_EVENTS = {
+        'is_input_plugged_in': {
+            True: INPUT_PLUGGED_IN,
+            False: INPUT_UNPLUGGED,
+        },
+        'is_charging': {
+            True: CHARGING_STARTED,
+            False: CHARGING_STOPPED,
+        },
+        'power_source': {
+            SPC.EXTERNAL_INPUT: POWER_SOURCE_EXTERNAL,
+            SPC.BATTERY: POWER_SOURCE_BATTERY,
+        },
+        'shutdown_request': {
+            SPC.SHUTDOWN_REQUEST_NONE: SHUTDOWN_REQUEST_CLEARED,
+            SPC.SHUTDOWN_REQUEST_LOW_BATTERY: SHUTDOWN_REQUEST_LOW_BATTERY,
+            SPC.SHUTDOWN_REQUEST_BUTTON: SHUTDOWN_REQUEST_BUTTON,
+            SPC.SHUTDOWN_REQUEST_LOW_BATTERY_VOLTAGE: SHUTDOWN_REQUEST_LOW_BATTERY_VOLTAGE,
+        },
+    }
+
+    BUTTON_EVENTS = {
+        SPC.POWER_BTN_RELEASED: BUTTON_RELEASED,
+        SPC.POWER_BTN_SINGLE_CLICKED: BUTTON_SINGLE_CLICKED,
+        SPC.POWER_BTN_DOUBLE_CLICKED: BUTTON_DOUBLE_CLICKED,
+        SPC.POWER_BTN_LONG_PRESSED_2S: BUTTON_LONG_PRESSED_2S,
+        SPC.POWER_BTN_LONG_PRESSED_2S_RELEASED: BUTTON_LONG_PRESSED_2S_RELEASED,
+        SPC.POWER_BTN_LONG_PRESSED_5S: BUTTON_LONG_PRESSED_5S,
+        SPC.POWER_BTN_LONG_PRESSED_5S_RELEASED: BUTTON_LONG_PRESSED_5S_RELEASED,
+    }
+
+    # Final button states, reset after reporting with reset_button
+    BUTTON_FINAL_STATES = (
+        SPC.POWER_BTN_SINGLE_CLICKED,
+        SPC.POWER_BTN_DOUBLE_CLICKED,
+        SPC.POWER_BTN_LONG_PRESSED_2S_RELEASED,
+        SPC.POWER_BTN_LONG_PRESSED_5S_RELEASED,
+    )
+
+    def __init__(self, spc, interval=1.0, debounce=2, watch_button=True, reset_button=False, poller=None, get_logger=None):
+        '''
+        spc, SPC object
+        interval, float, seconds between polls when started, unless poller is given
+        debounce, int or dict of field: int, consecutive snapshots a change must last
+        watch_button, bool, also read the power button state on every poll
+        reset_button, bool, write the power button state back to released after a final state
+        poller, Poller, follow the samples of this poller instead of polling on its own
+        '''
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.interval = interval
+        self.debounce = debounce
+        self.watch_button = watch_button
+        self.reset_button = reset_button
+        self._own_poller = poller is None
+        self.poller = Poller(spc, interval=interval, size=1, get_logger=get_logger) if poller is None else poller
+        self._remove_callback = None
+        self.fields = tuple(field for field in self.FIELD_EVENTS if field in spc.device.peripherals)
+        self._stable = {}
+        self._pending = {}
+        self._button_state = SPC.POWER_BTN_RELEASED
+        self._subscribers = []
+        self._queues = []
+        self._subscribers_lock = threading.Lock()
+
+    def subscribe(self, callback, types=None):
+        '''
+        Call callback(event) for every event, or only for the given event types.
+        Return a function that removes the subscription.
+        '''
+        subscriber = (callback, None if types is None else frozenset(types))
+        with self._subscribers_lock:
+            self._subscribers.append(subscriber)
+
+        def unsubscribe():
+            with self._subscribers_lock:
+                if subscriber in self._subscribers:
+                    self._subscribers.remove(subscriber)
+        return unsubscribe
+
+    def events(self, types=None, timeout=None):
+        '''
+        Iterate over events as they happen, stops when the monitor stops or
+        when no event comes within timeout seconds.
+        '''
+        events = queue.Queue()
+        with self._subscribers_lock:
+            self._queues.append(events)
+        unsubscribe = self.subscribe(events.put, types)
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=timeout)
+                except queue.Empty:
+                    return
+                if event is None:
+                    return
+                yield event
+        finally:
+            unsubscribe()
+            with self._subscribers_lock:
+                self._queues.remove(events)
+
+    def _emit(self, event):
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for callback, types in subscribers:
+            if types is not None and event.type not in types:
+                continue
+            try:
+                callback(event)
+            except Exception as e:
+                self.log.error(f'EventMonitor subscriber error: {e}')
+
+    def _debounce(self, field):
+        if isinstance(self.debounce, dict):
+            return self.debounce.get(field, 1)
+        return self.debounce
+
+    def feed(self, data, button_state=None, timestamp=None):
+        '''
+        Compare a read_all() snapshot and optional power button state with the
+        previous ones and emit the resulting events. Return the events.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        events = []
+        for field in self.fields:
+            value = data[field]
+            if field not in self._stable:
+                self._stable[field] = value
+                continue
+            if value == self._stable[field]:
+                self._pending.pop(field, None)
+                continue
+            pending_value, count = self._pending.get(field, (value, 0))
+            count = count + 1 if pending_value == value else 1
+            if count < self._debounce(field):
+                self._pending[field] = (value, count)
+                continue
+            self._pending.pop(field, None)
+            previous = self._stable[field]
+            self._stable[field] = value
+            event_type = self.FIELD_EVENTS[field].get(value, f'{field}_changed')
+            events.append(Event(event_type, field, value, previous, timestamp))
+
+        if button_state is not None and button_state != self._button_state:
+            event_type = self.BUTTON_EVENTS.get(button_state, 'power_btn_state_changed')
+            events.append(Event(event_type, 'power_btn_state', button_state, self._button_state, timestamp))
+            self._button_state = button_state
+
+        for event in events:
+            self._emit(event)
+        return events
+
+    def poll(self):
+        '''
+        Read the device once and emit the resulting events.
+        '''
+        return self._on_sample(time.time(), self.spc.read_all())
+
+    def _on_sample(self, timestamp, data):
+        # A failed button read only skips the button, the field changes still count
+        button_state = None
+        if self.watch_button:
+            try:
+                button_state = self.spc.read_power_btn_state()
+            except OSError as e:
+                self.log.warning(f'EventMonitor button read error: {e}')
+        events = self.feed(data, button_state, timestamp)
+        if self.reset_button and button_state in self.BUTTON_FINAL_STATES:
+            try:
+                self.spc.write_power_btn_state(SPC.POWER_BTN_RELEASED)
+                self._button_state = SPC.POWER_BTN_RELEASED
+            except OSError as e:
+                self.log.warning(f'EventMonitor button reset error: {e}')
+        return events
+
+    def start(self):
+        '''
+        Follow the poller samples, and start the poller if it is the monitor's own.
+        '''
+        if self._remove_callback is not None:
+            return
+        self._remove_callback = self.poller.add_callback(self._on_sample)
+        if self._own_poller:
+            self.poller.start()
+
+    def stop(self):
+        if self._remove_callback is None:
+            return
+        self._remove_callback()
+        self._remove_callback = None
+        if self._own_poller:
+            self.poller.stop()
+        # Ends the events() iterators
+        with self._subscribers_lock:
+            for events in self._queues:
+                events.put(None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+'''
+Prometheus/OpenMetrics exporter for SPC.
+
+A sampler thread reads the device at a fixed interval, scrapes are answered
+from the last sample and never touch the bus, so any number of scrapers
+cost the same I2C traffic.
+
+    spc-exporter --port 9877 --interval 1
+    curl http://127.0.0.1:9877/metrics
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from .poller import Poller
+from .spc import SPC
+
+# read_all field: (metric name, help)
+METRICS = {
+    'input_voltage': ('spc_input_voltage_millivolts', 'Input voltage in mV'),
+    'input_current': ('spc_input_current_milliamperes', 'Input current in mA'),
+    'output_voltage': ('spc_output_voltage_millivolts', 'Raspberry Pi voltage in mV'),
+    'output_current': ('spc_output_current_milliamperes', 'Raspberry Pi current in mA'),
+    'battery_voltage': ('spc_battery_voltage_millivolts', 'Battery voltage in mV'),
+    'battery_current': ('spc_battery_current_milliamperes', 'Battery current in mA, negative when discharging'),
+    'battery_percentage': ('spc_battery_percentage', 'Battery percentage'),
+    'battery_capacity': ('spc_battery_capacity_milliampere_hours', 'Battery capacity in mAh'),
+    'power_source': ('spc_power_source', 'Power source, 0 external input, 1 battery'),
+    'is_input_plugged_in': ('spc_input_plugged_in', 'Input plugged in'),
+    'is_charging': ('spc_charging', 'Battery charging'),
+    'fan_power': ('spc_fan_power_percent', 'Fan power in %'),
+    'shutdown_request': ('spc_shutdown_request', 'Shutdown request, 0 none, 1 low battery, 2 button, 3 low battery voltage'),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Exporter():
+    '''
+    spc, SPC object
+    interval, float, seconds between samples
+    host, port, address to serve the metrics on
+    '''
+    def __init__(self, spc, interval=1.0, host='127.0.0.1', port=9877, get_logger=None):
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.host = host
+        self.port = port
+        self.poller = Poller(spc, interval=interval, size=1, get_logger=get_logger)
+        self.labels = f'device="{_escape(spc.device.id)}",name="{_escape(spc.device.name)}"'
+        # Static, read once
+        self.firmware_version = spc.read_firmware_version()
+        self.board_id = spc.read_board_id()
+        self._rendered = {}
+        self._render_lock = threading.Lock()
+        self._server = None
+
+    def render(self, openmetrics=False):
+        '''
+        Return the metrics of the last sample, rendered once per sample.
+        '''
+        key = (self.poller.count, self.poller.errors, openmetrics)
+        rendered = self._rendered.get(openmetrics)
+        if rendered is not None and rendered[0] == key:
+            return rendered[1]
+        with self._render_lock:
+            text = self._render(openmetrics)
+            self._rendered[openmetrics] = (key, text)
+        return text
+
+    def _render(self, openmetrics):
+        lines = []
+        labels = self.labels
+
+        lines.append('# HELP spc_info SPC device information')
+        lines.append('# TYPE spc_info gauge')
+        lines.append(f'spc_info{{{labels},firmware_version="{_escape(self.firmware_version)}",board_id="{self.board_id}"}} 1')
+
+        latest = self.poller.latest()
+        if latest is not None:
+            timestamp, data = latest
+            for field, value in data.items():
+                name, help = METRICS.get(field, (f'spc_{field}', field))
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name}{{{labels}}} {int(value)}')
+            lines.append('# HELP spc_last_sample_timestamp_seconds Time of the last sample')
+            lines.append('# TYPE spc_last_sample_timestamp_seconds gauge')
+            lines.append(f'spc_last_sample_timestamp_seconds{{{labels}}} {timestamp:.3f}')
+
+        for name, help, value in (
+                ('spc_samples', 'Samples read from the device', self.poller.count),
+                ('spc_sample_errors', 'Failed sample reads', self.poller.errors)):
+            # OpenMetrics names the counter family without _total, the text format with it
+            family = name if openmetrics else f'{name}_total'
+            lines.append(f'# HELP {family} {help}')
+            lines.append(f'# TYPE {family} counter')
+            lines.append(f'{name}_total{{{labels}}} {value}')
+
+        if openmetrics:
+            lines.append('# EOF')
+        return ('\n'.join(lines) + '\n').encode()
+
+    def _handler(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+                body = exporter.render(openmetrics)
+                self.send_response(200)
+                self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                exporter.log.debug(format % args)
+
+        return Handler
+
+    def _serve(self):
+        self.poller.start()
+        self._server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.log.info(f'SPC exporter serving on http://{self.host}:{self.port}/metrics')
+
+    def start(self):
+        '''
+        Start sampling and serving in background threads.
+        '''
+        self._serve()
+        threading.Thread(target=self._server.serve_forever, name='spc-exporter', daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.poller.stop()
+
+    def serve_forever(self):
+        self._serve()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._server = None
+            self.poller.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve SPC data as Prometheus metrics')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=9877, help='port to listen on')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between samples')
+    parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    exporter = Exporter(SPC(bus=args.bus), interval=args.interval, host=args.host, port=args.port)
+    try:
+        exporter.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
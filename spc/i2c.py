@@ -1,56 +1,555 @@
-from smbus2 import SMBus
+from smbus2 import SMBus, i2c_msg
+import bisect
+import errno
+import fcntl
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+
+
+class BusLock():
+    '''
+    Lock serializing access to one I2C bus.
+
+    In-process it is shared by every I2C object on the same bus number, see
+    for_bus(). With lock_file it also takes an flock on that file, so other
+    processes using the same lock file wait too. It is reentrant, only the
+    outermost acquire takes the locks. Waiting time is counted, see stats().
+    '''
+    DEFAULT_LOCK_FILE = '/run/lock/spc-i2c-{bus}.lock'
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, lock_file=None):
+        self.lock_file = lock_file
+        self._lock = threading.Lock()
+        self._fd = None
+        self._owner = None
+        self._depth = 0
+        self.reset_stats()
+
+    @classmethod
+    def for_bus(cls, bus, lock_file=None):
+        '''
+        Return the lock shared by all users of bus in this process.
+        '''
+        with cls._locks_lock:
+            lock = cls._locks.get(bus)
+            if lock is None:
+                lock = cls._locks[bus] = cls(lock_file)
+            elif lock_file is not None and lock.lock_file is None:
+                lock.lock_file = lock_file
+            return lock
+
+    @staticmethod
+    def _open_lock_file(lock_file):
+        # flock works on read only files, so users that cannot write the file
+        # can lock it too. Make a new file readable by all despite the umask.
+        try:
+            fd = os.open(lock_file, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return os.open(lock_file, os.O_RDONLY)
+        os.fchmod(fd, 0o644)
+        return fd
+
+    def owned(self):
+        return self._owner == threading.get_ident()
+
+    def acquire(self):
+        if self._owner == threading.get_ident():
+            self._depth += 1
+            return
+        start = time.perf_counter()
+        contended = not self._lock.acquire(blocking=False)
+        if contended:
+            self._lock.acquire()
+        if self.lock_file is not None:
+            try:
+                if self._fd is None:
+                    self._fd = self._open_lock_file(self.lock_file)
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    contended = True
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        wait = time.perf_counter() - start
+        self._owner = threading.get_ident()
+        self._depth = 1
+        self.acquisitions += 1
+        self.wait_time += wait
+        if contended:
+            self.contended += 1
+        if wait > self.max_wait_time:
+            self.max_wait_time = wait
+
+    def release(self):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        self._owner = None
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def stats(self):
+        '''
+        Return lock usage, wait times in seconds.
+        '''
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+    def reset_stats(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+class CircuitOpenError(IOError):
+    '''
+    Raised without touching the bus while the circuit breaker is open.
+    '''
+    pass
+
+
+class RetryPolicy():
+    '''
+    Bounded retries of transient bus errors, with a circuit breaker.
+
+    A failed transfer is retried up to retries times, waiting backoff seconds
+    before the first retry and twice as long before every next one, at most
+    max_backoff, spread by jitter. No retry starts that would end after
+    deadline seconds from the start of the call, so a call takes at most
+    about deadline plus one transfer.
+
+    After breaker_threshold calls in a row failed, the breaker opens and calls
+    raise CircuitOpenError at once. After breaker_timeout seconds one call is
+    let through, its success closes the breaker again.
+
+    Outcomes are counted, see stats().
+    '''
+    TRANSIENT_ERRNOS = (errno.EREMOTEIO, errno.EAGAIN, errno.EIO, errno.ETIMEDOUT, errno.EBUSY)
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, retries=2, backoff=0.002, max_backoff=0.05, jitter=0.5, deadline=0.1,
+                 breaker_threshold=5, breaker_timeout=5.0, transient_errnos=TRANSIENT_ERRNOS, seed=None):
+        '''
+        retries, int, retries after the first attempt
+        backoff, float, seconds before the first retry
+        max_backoff, float, longest wait between retries
+        jitter, float, 0-1, random spread of the waits
+        deadline, float, seconds after which no more retries start, None for no limit
+        breaker_threshold, int, failed calls in a row that open the breaker, None to disable
+        breaker_timeout, float, seconds the breaker stays open
+        transient_errnos, errnos worth retrying, others fail at once
+        '''
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.transient_errnos = frozenset(transient_errnos)
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.breaker_timeout:
+                # Let one call through to probe the device
+                self.state = self.HALF_OPEN
+                return
+            self.short_circuited += 1
+        raise CircuitOpenError(errno.EAGAIN, f"Circuit open after {self._failures} failed calls")
+
+    def _after_call(self, ok):
+        with self._lock:
+            if ok:
+                self.successes += 1
+                self._failures = 0
+                self.state = self.CLOSED
+                return
+            self.failures += 1
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.breaker_threshold is not None and self._failures >= self.breaker_threshold):
+                if self.state != self.OPEN:
+                    self.breaker_opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def delay(self, attempt):
+        '''
+        Return the seconds to wait before retry number attempt, counted from 0.
+        '''
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 + self.jitter * self._random.uniform(-1, 1))
+
+    def call(self, lock, func, *args, **kwargs):
+        '''
+        Run func holding lock, retrying transient OSErrors. The lock is released
+        while waiting, so other users of the bus are not held up by the retries.
+        '''
+        self._before_call()
+        with self._lock:
+            self.calls += 1
+        try:
+            result = self._attempts(lock, func, args, kwargs)
+        except OSError:
+            self._after_call(False)
+            raise
+        except BaseException:
+            # Not a device failure, e.g. bad arguments, but a half open probe
+            # must not leave the breaker half open
+            self._abort_probe()
+            raise
+        self._after_call(True)
+        return result
+
+    def _abort_probe(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _attempts(self, lock, func, args, kwargs):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                with lock:
+                    return func(*args, **kwargs)
+            except OSError as e:
+                if e.errno not in self.transient_errnos or attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt)
+                if self.deadline is not None and time.monotonic() - start + delay > self.deadline:
+                    with self._lock:
+                        self.deadline_exceeded += 1
+                    raise
+                with self._lock:
+                    self.retried += 1
+                attempt += 1
+                time.sleep(delay)
+
+    def stats(self):
+        '''
+        Return the call outcomes and the breaker state.
+        '''
+        return {
+            'calls': self.calls,
+            'successes': self.successes,
+            'failures': self.failures,
+            'retried': self.retried,
+            'deadline_exceeded': self.deadline_exceeded,
+            'short_circuited': self.short_circuited,
+            'breaker_opened': self.breaker_opened,
+            'state': self.state,
+        }
+
+    def reset_stats(self):
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retried = 0
+        self.deadline_exceeded = 0
+        self.short_circuited = 0
+        self.breaker_opened = 0
+
+
+class BusStats():
+    '''
+    Counters of the I2C calls of one or more I2C objects.
+
+    Calls are counted per (method, register, mode) with the bytes moved and
+    the time taken, in a latency histogram per method with the fixed upper
+    bounds of BUCKETS, and failed calls per errno. Only the outermost call is
+    counted, e.g. an esp32 read_byte_data is one call, not two. Hooks are
+    called after every call with (method, register, mode, size, seconds, error).
+
+    stats = BusStats()
+    i2c = I2C(0x5C, stats=stats)
+    print(stats.snapshot())
+    '''
+    # Latency histogram upper bounds in seconds, the last bucket counts the rest
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+    # Bytes moved by the methods that do not take or return a list
+    SIZES = {
+        'read_byte': 1,
+        'write_byte': 1,
+        'read_byte_data': 1,
+        'write_byte_data': 1,
+        'read_word_data': 2,
+        'write_word_data': 2,
+        'is_ready': 0,
+    }
+
+    def __init__(self, get_logger=None):
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.histograms = {}
+            self.errnos = {}
+
+    def add_hook(self, callback):
+        '''
+        Call callback(method, register, mode, size, seconds, error) after every call,
+        error is None for successful calls. Return a function that removes the hook.
+        '''
+        with self._lock:
+            self._hooks = self._hooks + [callback]
+
+        def remove():
+            with self._lock:
+                self._hooks = [hook for hook in self._hooks if hook is not callback]
+        return remove
+
+    def record(self, method, reg, mode, size, elapsed, error=None):
+        key = (method, reg, mode)
+        bucket = bisect.bisect_left(self.BUCKETS, elapsed)
+        with self._lock:
+            entry = self.calls.get(key)
+            if entry is None:
+                entry = self.calls[key] = [0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += size
+            entry[3] += elapsed
+            if error is not None:
+                entry[2] += 1
+                self.errnos[error.errno] = self.errnos.get(error.errno, 0) + 1
+            histogram = self.histograms.get(method)
+            if histogram is None:
+                histogram = self.histograms[method] = [0] * (len(self.BUCKETS) + 1)
+            histogram[bucket] += 1
+            hooks = self._hooks
+        for hook in hooks:
+            try:
+                hook(method, reg, mode, size, elapsed, error)
+            except Exception as e:
+                self.log.error(f'BusStats hook error: {e}')
+
+    def size(self, method, arguments, result):
+        '''
+        arguments, dict, the call arguments by name
+        '''
+        if method == 'read_block_buffer':
+            # Returns whatever decode makes of the data, the size is num
+            return arguments['num']
+        if isinstance(result, (list, bytes, bytearray, memoryview)):
+            return len(result)
+        size = self.SIZES.get(method)
+        if size is not None:
+            return size
+        # Writes of a list of data after the register
+        data = arguments.get('data')
+        return len(data) if isinstance(data, (list, tuple, bytes, bytearray)) else 1
+
+    def snapshot(self):
+        '''
+        Return a copy of the counters, times in seconds.
+        '''
+        with self._lock:
+            calls = [
+                {'method': method, 'register': reg, 'mode': mode,
+                 'count': count, 'bytes': size, 'errors': errors, 'time': elapsed}
+                for (method, reg, mode), (count, size, errors, elapsed) in self.calls.items()
+            ]
+            histograms = {method: list(histogram) for method, histogram in self.histograms.items()}
+            errnos = dict(self.errnos)
+        return {
+            'count': sum(call['count'] for call in calls),
+            'bytes': sum(call['bytes'] for call in calls),
+            'errors': sum(call['errors'] for call in calls),
+            'time': sum(call['time'] for call in calls),
+            'calls': calls,
+            'latency_buckets': self.BUCKETS,
+            'latency': histograms,
+            'errors_by_errno': errnos,
+        }
+
+
+def _atomic(func):
+    '''
+    Run the method holding the bus lock, so multi step transfers are not interleaved.
+    With a retry policy the outermost call is retried as a whole.
+    '''
+    signature = inspect.signature(func)
+
+    def call(self, *args, **kwargs):
+        if self.retry is None or self.lock.owned():
+            with self.lock:
+                return func(self, *args, **kwargs)
+        return self.retry.call(self.lock, func, self, *args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            if self.retry is None or self.lock.owned():
+                with self.lock:
+                    return func(self, *args, **kwargs)
+            return self.retry.call(self.lock, func, self, *args, **kwargs)
+        local = stats._local
+        depth = getattr(local, 'depth', 0)
+        if depth:
+            return call(self, *args, **kwargs)
+        local.depth = 1
+        start = time.perf_counter()
+        try:
+            result = call(self, *args, **kwargs)
+        except OSError as e:
+            elapsed = time.perf_counter() - start
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            stats.record(func.__name__, arguments.get('reg'), self._mode, 0, elapsed, e)
+            raise
+        finally:
+            local.depth = 0
+        elapsed = time.perf_counter() - start
+        # Arguments by name, whether they were passed by position or keyword
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        stats.record(func.__name__, arguments.get('reg'), self._mode, stats.size(func.__name__, arguments, result), elapsed)
+        return result
+    return wrapper
+
 
 class I2C():
-    def __init__(self, address, bus=1, mode="normal"):
+    BACKEND_SMBUS2 = 'smbus2'
+    BACKEND_I2C_DEV = 'i2c-dev'
+
+    # Longest block read of one transfer per mode, None for no limit
+    BLOCK_MAX = {
+        'normal': 32,
+        'esp32': None,
+    }
+
+    def __init__(self, address, bus=1, mode="normal", smbus=None, esp32_combined=True, lock_file=None, retry=None, stats=None):
+        '''
+        esp32_combined, bool, in esp32 mode send the read command and read the data back
+            in one combined transfer, set False to send them as two separate transfers
+        lock_file, str, also lock the bus across processes with flock on this file,
+            e.g. BusLock.DEFAULT_LOCK_FILE.format(bus=1)
+        retry, RetryPolicy, retry transient errors, None to raise them at once
+        stats, BusStats, count the calls, None to not count them
+        '''
         self._address = address
+        self._esp32_combined = esp32_combined
         self._bus = bus
-        self._smbus = SMBus(self._bus)
+        if smbus is None:
+            smbus = SMBus(self._bus)
+        self._smbus = smbus
+        # Backends like I2CDev read into a reusable buffer
+        self._buffered = hasattr(smbus, 'write_read_view')
         self._mode = mode
+        self.lock = BusLock.for_bus(bus, lock_file)
+        self.retry = retry
+        self.stats = stats
+
+    @staticmethod
+    def open_bus(busnum=1, backend=BACKEND_SMBUS2):
+        '''
+        backend, str, BACKEND_SMBUS2 or BACKEND_I2C_DEV, see spc.i2c_dev.I2CDev
+        '''
+        if backend == I2C.BACKEND_SMBUS2:
+            return SMBus(busnum)
+        if backend == I2C.BACKEND_I2C_DEV:
+            from .i2c_dev import I2CDev
+            return I2CDev(busnum)
+        raise ValueError(f"Unknown I2C backend: {backend}")
 
+    @_atomic
     def esp32_write(self, reg, data):
         _cmd = 0x02
         if not isinstance(data, list):
             data = [data]
         return self._smbus.write_i2c_block_data(self._address, _cmd, [reg]+data)
 
-    def esp32_read(self, reg, len):
+    @_atomic
+    def esp32_read(self, reg, num):
         _cmd = 0x01
-        self._smbus.write_i2c_block_data(self._address, _cmd, [reg])
-        result = []
-        for _ in range(len):
-            result.append(self.read_byte())
-        return result
+        read = i2c_msg.read(self._address, num)
+        if self._esp32_combined:
+            write = i2c_msg.write(self._address, [_cmd, reg])
+            self._smbus.i2c_rdwr(write, read)
+        else:
+            self._smbus.write_i2c_block_data(self._address, _cmd, [reg])
+            self._smbus.i2c_rdwr(read)
+        return list(bytes(read))
 
+    @_atomic
     def write_byte(self, data):
         return self._smbus.write_byte(self._address, data)
 
+    @_atomic
     def write_byte_data(self, reg, data):
         if self._mode == "normal":
             return self._smbus.write_byte_data(self._address, reg, data)
         elif self._mode == "esp32":
             return self.esp32_write(reg, data)
 
+    @_atomic
     def write_word_data(self, reg, data):
         if self._mode == "normal":
             return self._smbus.write_word_data(self._address, reg, data)
         elif self._mode == "esp32":
             return self.esp32_write(reg, data)
 
+    @_atomic
     def write_block_data(self, reg, data):
         if self._mode == "normal":
             return self._smbus.write_i2c_block_data(self._address, reg, data)
         elif self._mode == "esp32":
             return self.esp32_write(reg, data)
 
+    @_atomic
     def read_byte(self):
         return self._smbus.read_byte(self._address)
 
+    @_atomic
     def read_byte_data(self, reg):
         if self._mode == "normal":
             return self._smbus.read_byte_data(self._address, reg)
         elif self._mode == "esp32":
             return self.esp32_read(reg, 1)[0]
             
+    @_atomic
     def read_word_data(self, reg):
         if self._mode == "normal":
             return self._smbus.read_word_data(self._address, reg)
@@ -58,33 +557,83 @@ class I2C():
             result = self.esp32_read(reg, 2)
             return result[1]<<8 | result[0]
 
+    @_atomic
     def read_block_data(self, reg, num):
         if self._mode == "normal":
             return self._smbus.read_i2c_block_data(self._address, reg, num)
         elif self._mode == "esp32":
             return self.esp32_read(reg, num)
 
+    @_atomic
+    def read_block_buffer(self, reg, num, decode=bytes):
+        '''
+        Read num registers from reg and return decode(data), called while the
+        bus lock is held. With a buffered backend data is a view into the
+        backend read buffer, so decode can unpack it without a copy, e.g.
+        a struct.Struct.unpack_from.
+        '''
+        if not self._buffered:
+            return decode(bytes(self.read_block_data(reg, num)))
+        if self._mode == "esp32":
+            if self._esp32_combined:
+                return decode(self._smbus.write_read_view(self._address, (0x01, reg), num))
+            self._smbus.write(self._address, (0x01, reg))
+            return decode(self._smbus.read_view(self._address, num))
+        return decode(self._smbus.write_read_view(self._address, (reg, ), num))
+
+    @_atomic
+    def read_range(self, reg, num):
+        '''
+        Read num registers from reg, split in as few block reads as the mode allows.
+        '''
+        block_max = self.BLOCK_MAX[self._mode] or num
+        result = []
+        for start in range(reg, reg + num, block_max):
+            result += self.read_block_data(start, min(block_max, reg + num - start))
+        return result
+
+    @_atomic
     def is_ready(self):
-        addresses = I2C.scan(self._bus)
-        if self._address in addresses:
-            return True
-        else:
-            return False
+        return I2C.probe_address(self._smbus, self._address)
 
     @staticmethod
-    def scan(busnum=1, force=False):
-        devices = []
-        for addr in range(0x03, 0x77 + 1):
-            read = SMBus.read_byte, (addr,), {'force':force}
-            write = SMBus.write_byte, (addr, 0), {'force':force}
-            for func, args, kwargs in (read, write):
-                try:
-                    with SMBus(busnum) as bus:
-                        data = func(bus, *args, **kwargs)
-                        devices.append(addr)
-                        break
-                except OSError as expt:
-                    if expt.errno == 16:
-                        # just busy, maybe permanent by a kernel driver or just temporary by some user code
-                        pass
-        return devices
+    def probe_address(bus, addr, force=False, busy=None):
+        '''
+        Check if a device acknowledges at addr, using an already opened bus.
+
+        busy, list, addr is appended to it if the address is busy
+        '''
+        read = bus.read_byte, (addr,), {'force':force}
+        write = bus.write_byte, (addr, 0), {'force':force}
+        for func, args, kwargs in (read, write):
+            try:
+                func(*args, **kwargs)
+                return True
+            except OSError as expt:
+                if expt.errno == errno.EBUSY:
+                    # just busy, maybe permanent by a kernel driver or just temporary by some user code
+                    if busy is not None and addr not in busy:
+                        busy.append(addr)
+        return False
+
+    @staticmethod
+    def probe(addresses, busnum=1, force=False, smbus=None, busy=None):
+        '''
+        Probe only the given addresses over one bus handle, return the ones that answer.
+
+        busy, list, busy addresses are appended to it, e.g. claimed by a kernel driver
+        '''
+        lock = BusLock.for_bus(busnum)
+        if smbus is not None:
+            return [addr for addr in addresses if I2C._probe_locked(lock, smbus, addr, force, busy)]
+        with SMBus(busnum) as bus:
+            return [addr for addr in addresses if I2C._probe_locked(lock, bus, addr, force, busy)]
+
+    @staticmethod
+    def _probe_locked(lock, bus, addr, force, busy):
+        with lock:
+            return I2C.probe_address(bus, addr, force, busy)
+
+    @staticmethod
+    def scan(busnum=1, force=False, smbus=None, busy=None):
+        return I2C.probe(range(0x03, 0x77 + 1), busnum, force, smbus, busy)
@@ -0,0 +1,144 @@
+import ctypes
+import fcntl
+import os
+
+from smbus2.smbus2 import i2c_rdwr_ioctl_data
+
+# linux/i2c-dev.h
+I2C_RDWR = 0x0707
+# linux/i2c.h
+I2C_M_RD = 0x0001
+
+WRITE_MAX = 64
+READ_MAX = 256
+
+
+class _Msg(ctypes.Structure):
+    _fields_ = [
+        ('addr', ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len', ctypes.c_uint16),
+        ('buf', ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class _RdwrData(ctypes.Structure):
+    _fields_ = [
+        ('msgs', ctypes.POINTER(_Msg)),
+        ('nmsgs', ctypes.c_uint32),
+    ]
+
+
+class I2CDev():
+    '''
+    Bus backend talking to /dev/i2c-N with I2C_RDWR ioctls, through buffers and
+    ioctl structures allocated once, so repeated reads create no new objects
+    but the returned view.
+
+    It has the SMBus methods the I2C class uses, done as plain I2C transfers
+    (register write, repeated start, read), plus write_read_view() which
+    returns the data as a view into the read buffer. I2C.read_block_buffer()
+    and SPC.read_all() use it when available.
+
+    spc = SPC(backend=I2C.BACKEND_I2C_DEV)
+    '''
+    def __init__(self, bus=1):
+        '''
+        bus, int, I2C bus number
+        '''
+        self.bus = bus
+        self.fd = os.open(f'/dev/i2c-{bus}', os.O_RDWR)
+        self._write_buffer = bytearray(WRITE_MAX)
+        self._read_buffer = bytearray(READ_MAX)
+        self._read_view = memoryview(self._read_buffer)
+        write_pointer = ctypes.cast((ctypes.c_uint8 * WRITE_MAX).from_buffer(self._write_buffer), ctypes.POINTER(ctypes.c_uint8))
+        read_pointer = ctypes.cast((ctypes.c_uint8 * READ_MAX).from_buffer(self._read_buffer), ctypes.POINTER(ctypes.c_uint8))
+        # [write, read] for combined transfers, the first one alone for writes
+        self._msgs = (_Msg * 2)()
+        self._msgs[0].buf = write_pointer
+        self._msgs[1].flags = I2C_M_RD
+        self._msgs[1].buf = read_pointer
+        self._read_msgs = (_Msg * 1)()
+        self._read_msgs[0].flags = I2C_M_RD
+        self._read_msgs[0].buf = read_pointer
+        self._write_read = _RdwrData(self._msgs, 2)
+        self._write_only = _RdwrData(self._msgs, 1)
+        self._read_only = _RdwrData(self._read_msgs, 1)
+
+    def _set_write(self, addr, data):
+        size = len(data)
+        if size > WRITE_MAX:
+            raise ValueError(f"Data length cannot exceed {WRITE_MAX} bytes")
+        self._write_buffer[:size] = data
+        self._msgs[0].addr = addr
+        self._msgs[0].len = size
+
+    def write_read_view(self, addr, data, num):
+        '''
+        Write data then read num bytes in one combined transfer, return a
+        memoryview of the read buffer, valid until the next read.
+        '''
+        if num > READ_MAX:
+            raise ValueError(f"Desired length over {READ_MAX} bytes")
+        self._set_write(addr, data)
+        self._msgs[1].addr = addr
+        self._msgs[1].len = num
+        fcntl.ioctl(self.fd, I2C_RDWR, self._write_read)
+        return self._read_view[:num]
+
+    def read_view(self, addr, num):
+        '''
+        Read num bytes, return a memoryview of the read buffer, valid until the next read.
+        '''
+        if num > READ_MAX:
+            raise ValueError(f"Desired length over {READ_MAX} bytes")
+        self._read_msgs[0].addr = addr
+        self._read_msgs[0].len = num
+        fcntl.ioctl(self.fd, I2C_RDWR, self._read_only)
+        return self._read_view[:num]
+
+    def write(self, addr, data):
+        self._set_write(addr, data)
+        fcntl.ioctl(self.fd, I2C_RDWR, self._write_only)
+
+    def read_byte(self, i2c_addr, force=None):
+        return self.read_view(i2c_addr, 1)[0]
+
+    def write_byte(self, i2c_addr, value, force=None):
+        self.write(i2c_addr, (value, ))
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        return self.write_read_view(i2c_addr, (register, ), 1)[0]
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self.write(i2c_addr, (register, value))
+
+    def read_word_data(self, i2c_addr, register, force=None):
+        data = self.write_read_view(i2c_addr, (register, ), 2)
+        return data[1] << 8 | data[0]
+
+    def write_word_data(self, i2c_addr, register, value, force=None):
+        self.write(i2c_addr, (register, value & 0xFF, value >> 8))
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        return list(self.write_read_view(i2c_addr, (register, ), length))
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self.write(i2c_addr, [register] + list(data))
+
+    def i2c_rdwr(self, *i2c_msgs):
+        '''
+        Combined transfer of smbus2 i2c_msg messages, like SMBus.i2c_rdwr.
+        '''
+        fcntl.ioctl(self.fd, I2C_RDWR, i2c_rdwr_ioctl_data.create(*i2c_msgs))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
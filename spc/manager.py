@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .devices import Devices
+from .i2c import I2C
+from .spc import SPC
+
+
+class SPCManager():
+    '''
+    Every supported board on a list of I2C buses, read in parallel.
+
+    Each bus gets one worker thread, boards on the same bus are read one after
+    another by it, so a poll takes as long as the slowest bus. Results are
+    keyed by (bus, address).
+
+    manager = SPCManager(buses=[1, 3])
+    for (bus, address), data in manager.read_all().items():
+        print(bus, hex(address), data['battery_percentage'])
+    '''
+    def __init__(self, buses=(1, ), discovery=SPC.DISCOVERY_PROBE, smbus_factory=None, get_logger=None, **kwargs):
+        '''
+        buses, list of int, I2C bus numbers
+        discovery, str, SPC.DISCOVERY_PROBE or SPC.DISCOVERY_SCAN
+        smbus_factory, function(bus) returning an SMBus like object, default I2C.open_bus
+        kwargs, passed to every SPC, e.g. cache_ttl or lock_file
+        '''
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+        self._get_logger = get_logger
+
+        if smbus_factory is None:
+            smbus_factory = I2C.open_bus
+        self.buses = tuple(buses)
+        self.boards = {}
+        self.errors = {}
+        self._smbus = {}
+        self._executors = {}
+        self._board_keys = {}
+
+        futures = {}
+        for bus in self.buses:
+            try:
+                smbus = smbus_factory(bus)
+            except OSError as e:
+                self.log.warning(f'SPCManager: skip bus {bus}: {e}')
+                continue
+            self._smbus[bus] = smbus
+            self._executors[bus] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'spc-bus{bus}')
+            futures[bus] = self._executors[bus].submit(self._discover, bus, smbus, discovery, kwargs)
+        for bus, future in futures.items():
+            boards = future.result()
+            self._board_keys[bus] = tuple(boards)
+            self.boards.update(boards)
+        self.log.info(f'SPCManager found {len(self.boards)} board(s): '
+                      + ', '.join(f'{spc.device.name} on bus {bus} at 0x{addr:02X}' for (bus, addr), spc in self.boards.items()))
+
+    def _discover(self, bus, smbus, discovery, kwargs):
+        if discovery == SPC.DISCOVERY_PROBE:
+            addresses = I2C.probe(Devices.ADDRESS, bus, smbus=smbus)
+        elif discovery == SPC.DISCOVERY_SCAN:
+            addresses = I2C.scan(bus, smbus=smbus)
+        else:
+            raise ValueError(f"Unknown discovery mode: {discovery}")
+        boards = {}
+        for addr in Devices.ADDRESS:
+            if addr not in addresses:
+                continue
+            spc = SPC(get_logger=self._get_logger, bus=bus, address=addr, smbus=smbus, **kwargs)
+            if not spc.is_ready() or not spc.confirm_board():
+                continue
+            boards[(bus, addr)] = spc
+        return boards
+
+    def _call_bus(self, bus, method, args, kwargs):
+        results = {}
+        errors = {}
+        for key in self._board_keys[bus]:
+            try:
+                results[key] = getattr(self.boards[key], method)(*args, **kwargs)
+            except (OSError, ValueError) as e:
+                errors[key] = e
+        return results, errors
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        '''
+        Call an SPC method on every board, buses in parallel.
+
+        Return {(bus, address): result} of the boards that succeeded, the
+        errors of the others are in self.errors.
+        '''
+        futures = [executor.submit(self._call_bus, bus, method, args, kwargs)
+                   for bus, executor in self._executors.items()]
+        done, not_done = wait(futures, timeout)
+        if not_done:
+            raise TimeoutError(f"SPCManager {method} timed out on {len(not_done)} bus(es)")
+        results = {}
+        errors = {}
+        for future in futures:
+            bus_results, bus_errors = future.result()
+            results.update(bus_results)
+            errors.update(bus_errors)
+        for key, e in errors.items():
+            self.log.warning(f'SPCManager {method} error on bus {key[0]} at 0x{key[1]:02X}: {e}')
+        self.errors = errors
+        return results
+
+    def read_all(self, timeout=None):
+        return self.call('read_all', timeout=timeout)
+
+    def read_extended(self, timeout=None):
+        return self.call('read_extended', timeout=timeout)
+
+    def __getitem__(self, key):
+        return self.boards[key]
+
+    def __iter__(self):
+        return iter(self.boards)
+
+    def __len__(self):
+        return len(self.boards)
+
+    def close(self):
+        for executor in self._executors.values():
+            executor.shutdown()
+        self._executors = {}
+        for smbus in self._smbus.values():
+            close = getattr(smbus, 'close', None)
+            if close is not None:
+                close()
+        self._smbus = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
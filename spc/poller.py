@@ -0,0 +1,157 @@
+from array import array
+from bisect import bisect_left
+import threading
+import time
+
+# read_all field struct format to array typecode
+TYPECODES = {
+    'H': 'H',
+    'h': 'h',
+    'B': 'B',
+    '?': 'B',
+}
+
+
+class Poller():
+    '''
+    Sample spc.read_all() at a fixed rate on a background thread, keeping the
+    last size samples in preallocated arrays, one column per field.
+
+    spc, SPC object
+    interval, float, seconds between samples
+    size, int, number of samples kept
+
+    poller = Poller(spc, interval=0.1)
+    poller.start()
+    timestamp, data = poller.latest()
+    timestamps, columns = poller.window(seconds=10)
+
+    Other consumers can follow the samples with add_callback() instead of
+    polling on their own.
+    '''
+    def __init__(self, spc, interval=1.0, size=3600, get_logger=None):
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.interval = interval
+        self.size = size
+        self.count = 0
+        self.errors = 0
+        self._latest = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        # Every sample is written at i and i + size, so the last n samples are
+        # always one contiguous slice and window() never copies.
+        self.fields = tuple(name for name, _, _ in spc.read_all_fields)
+        self._timestamps = array('d', bytes(array('d').itemsize * 2 * size))
+        self._columns = {}
+        for name, _, fmt in spc.read_all_fields:
+            typecode = TYPECODES[fmt]
+            self._columns[name] = array(typecode, bytes(array(typecode).itemsize * 2 * size))
+
+    def add_callback(self, callback):
+        '''
+        Call callback(timestamp, data) after every sample, on the polling
+        thread. Return a function that removes the callback.
+        '''
+        with self._callbacks_lock:
+            self._callbacks = self._callbacks + [callback]
+
+        def remove():
+            with self._callbacks_lock:
+                self._callbacks = [other for other in self._callbacks if other is not callback]
+        return remove
+
+    def record(self, data, timestamp=None):
+        '''
+        Store a read_all() result, called by the polling thread.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        i = self.count % self.size
+        j = i + self.size
+        for name, column in self._columns.items():
+            column[i] = column[j] = data[name]
+        self._timestamps[i] = self._timestamps[j] = timestamp
+        self._latest = (timestamp, data)
+        self.count += 1
+
+    def latest(self):
+        '''
+        Return (timestamp, data) of the last sample, None if there is none yet.
+        '''
+        return self._latest
+
+    def window(self, count=None, seconds=None):
+        '''
+        Return (timestamps, columns) of the last count samples, or of the
+        samples of the last seconds, as memoryviews into the ring buffer.
+
+        The views are not copies, they are overwritten once the poller wraps
+        around, copy them if they are kept longer than size samples.
+        '''
+        available = min(self.count, self.size)
+        if count is None or count > available:
+            count = available
+        end = (self.count - 1) % self.size + self.size + 1 if self.count else 0
+        start = end - count
+        timestamps = memoryview(self._timestamps)
+        if seconds is not None and count:
+            start = bisect_left(timestamps, timestamps[end - 1] - seconds, start, end)
+        columns = {name: memoryview(column)[start:end] for name, column in self._columns.items()}
+        return timestamps[start:end], columns
+
+    def poll(self):
+        try:
+            data = self.spc.read_all()
+        except OSError as e:
+            self.errors += 1
+            self.log.warning(f'Poller read error: {e}')
+            return None
+        timestamp = time.time()
+        self.record(data, timestamp)
+        for callback in self._callbacks:
+            try:
+                callback(timestamp, data)
+            except Exception as e:
+                self.log.error(f'Poller callback error: {e}')
+        return data
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            self.poll()
+            next_time += self.interval
+            delay = next_time - time.monotonic()
+            if delay < 0:
+                # Running late, skip the missed samples instead of bursting
+                next_time = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='spc-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
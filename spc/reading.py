@@ -0,0 +1,106 @@
+from array import array
+from collections import namedtuple
+import time
+
+from .poller import TYPECODES
+
+_types = {}
+
+
+def reading_type(device_id, fields):
+    '''
+    Return the Reading type of a device, a namedtuple of its read_all fields
+    with to_dict(). Types are created once per device and field list.
+
+    device_id, str, device id, e.g. spc.device.id
+    fields, tuple of (name, register, struct format) like spc.read_all_fields
+    '''
+    names = tuple(field[0] for field in fields)
+    key = (device_id, names)
+    reading = _types.get(key)
+    if reading is not None:
+        return reading
+
+    class Reading(namedtuple(f'Reading_{device_id}', names)):
+        __slots__ = ()
+        # Field formats, '?' for flags
+        formats = tuple(field[-1] for field in fields)
+        flags = tuple(i for i, field in enumerate(fields) if field[-1] == '?')
+
+        def to_dict(self):
+            '''
+            Return the reading as a dict like read_all().
+            '''
+            return dict(zip(self._fields, self))
+
+        @classmethod
+        def from_values(cls, values):
+            '''
+            Make a reading from raw unpacked values, flags as 0 or 1.
+            '''
+            if cls.flags:
+                values = list(values)
+                for i in cls.flags:
+                    values[i] = values[i] == 1
+            return cls._make(values)
+
+    Reading.__qualname__ = Reading.__name__ = f'Reading_{device_id}'
+    _types[key] = Reading
+    return Reading
+
+
+class ReadingBatch():
+    '''
+    Readings of one device stored by column in typed arrays, with their
+    timestamps. A retained sample takes a few bytes per field instead of
+    a dict or tuple per sample.
+
+    batch = ReadingBatch(spc.Reading)
+    batch.append(spc.read_reading())
+    print(batch.column('battery_voltage'), batch[-1].battery_percentage)
+    '''
+    def __init__(self, reading_type):
+        '''
+        reading_type, Reading type, e.g. spc.Reading
+        '''
+        self.reading_type = reading_type
+        self.fields = reading_type._fields
+        self.timestamps = array('d')
+        self._columns = tuple(array(TYPECODES[fmt]) for fmt in reading_type.formats)
+
+    def append(self, reading, timestamp=None):
+        '''
+        reading, Reading or a read_all() dict
+        timestamp, float, default now
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(reading, dict):
+            reading = [reading[name] for name in self.fields]
+        for column, value in zip(self._columns, reading):
+            column.append(value)
+        self.timestamps.append(timestamp)
+
+    def column(self, name):
+        '''
+        Return the array of one field.
+        '''
+        return self._columns[self.fields.index(name)]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        return self.reading_type.from_values([column[index] for column in self._columns])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_dicts(self):
+        return [reading.to_dict() for reading in self]
+
+    def clear(self):
+        del self.timestamps[:]
+        for column in self._columns:
+            del column[:]
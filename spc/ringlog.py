@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'SPCR'
+VERSION = 1
+
+# magic, version, record size, capacity, head, count, record format, field names
+HEADER = struct.Struct('<4sHHIQQ64s384s')
+HEADER_SIZE = 512
+TIMESTAMP = struct.Struct('<d')
+
+
+class RingLog():
+    '''
+    Fixed size binary ring file of read_all() samples, memory mapped.
+
+    Every record is a timestamp followed by the device fields, packed with a
+    struct format built from the device profile. Writes are buffered and
+    applied batch_size records at a time, or at least every flush_interval
+    seconds, to limit SD card writes. Readers open the file read-only and
+    get time ranges as raw record views or unpacked tuples.
+
+    Time ranges are found by binary search, so records must be in time
+    order. A timestamp older than the last appended one, e.g. after the
+    clock stepped back at NTP sync, is stored as the last one instead.
+
+    log = RingLog.for_spc('/var/log/spc.ring', spc, capacity=7*24*3600)
+    log.append(spc.read_all())
+
+    log = RingLog('/var/log/spc.ring', readonly=True)
+    for timestamp, *values in log.records(time.time() - 3600):
+        ...
+    '''
+    def __init__(self, path, fields=None, capacity=None, batch_size=60, flush_interval=60, readonly=False):
+        '''
+        path, str, ring file path
+        fields, list of (name, register, struct format) like spc.read_all_fields,
+            or (name, struct format), needed to create the file
+        capacity, int, number of records, needed to create the file
+        batch_size, int, buffered records before they are written
+        flush_interval, float, seconds before buffered records are written anyway
+        readonly, bool, open an existing file for reading only
+        '''
+        self.path = path
+        self.readonly = readonly
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+        if fields is not None:
+            names = [field[0] for field in fields]
+            fmt = '<d' + ''.join(field[-1] for field in fields).replace('?', 'B')
+        if not os.path.exists(path):
+            if readonly or fields is None or capacity is None:
+                raise FileNotFoundError(f"Ring log {path} not found")
+            self._create(path, names, fmt, capacity)
+
+        self._file = open(path, 'rb' if readonly else 'r+b')
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=access)
+        magic, version, record_size, self.capacity, _, _, file_fmt, file_names = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a ring log")
+        self.format = file_fmt.rstrip(b'\0').decode()
+        self.fields = file_names.rstrip(b'\0').decode().split(',')
+        self.record = struct.Struct(self.format)
+        if fields is not None and (fmt != self.format or names != self.fields):
+            raise ValueError(f"Ring log {path} was created for other fields")
+        head, count = self._header()
+        self._last_timestamp = self._timestamp((head - 1) % self.capacity) if count else float('-inf')
+
+    @classmethod
+    def for_spc(cls, path, spc, capacity=86400, **kwargs):
+        return cls(path, spc.read_all_fields, capacity, **kwargs)
+
+    @staticmethod
+    def _create(path, names, fmt, capacity):
+        record_size = struct.calcsize(fmt)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, record_size, capacity, 0, 0, fmt.encode(), ','.join(names).encode()))
+            f.truncate(HEADER_SIZE + record_size * capacity)
+
+    def _header(self):
+        _, _, _, _, head, count, _, _ = HEADER.unpack_from(self._mmap, 0)
+        return head, count
+
+    def append(self, data, timestamp=None):
+        '''
+        Buffer a read_all() result, written once the batch is full or old enough.
+        '''
+        if self.readonly:
+            raise IOError(f"Ring log {self.path} is open read only")
+        if timestamp is None:
+            timestamp = time.time()
+        if timestamp < self._last_timestamp:
+            timestamp = self._last_timestamp
+        self._last_timestamp = timestamp
+        self._pending.append((timestamp, ) + tuple(data[name] for name in self.fields))
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.readonly:
+            return
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        head, count = self._header()
+        for values in self._pending:
+            self.record.pack_into(self._mmap, HEADER_SIZE + head * self.record.size, *values)
+            head = (head + 1) % self.capacity
+            count += 1
+        self._pending = []
+        # Header last, so readers never see a record before it is complete
+        _, _, record_size, capacity, _, _, fmt, names = HEADER.unpack_from(self._mmap, 0)
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, record_size, capacity, head, count, fmt, names)
+        self._mmap.flush()
+
+    def __len__(self):
+        _, count = self._header()
+        return min(count, self.capacity)
+
+    def _timestamp(self, position):
+        return TIMESTAMP.unpack_from(self._mmap, HEADER_SIZE + position * self.record.size)[0]
+
+    def _index(self, timestamp, oldest, length):
+        # First record at or after timestamp, records are in time order
+        lo, hi = 0, length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp((oldest + mid) % self.capacity) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def slice(self, start=None, end=None):
+        '''
+        Return the raw records with start <= timestamp < end, oldest first, as
+        at most two memoryviews into the file. Release the views before close().
+        '''
+        head, count = self._header()
+        length = min(count, self.capacity)
+        oldest = head if count >= self.capacity else 0
+        first = 0 if start is None else self._index(start, oldest, length)
+        last = length if end is None else self._index(end, oldest, length)
+        if first >= last:
+            return []
+        size = self.record.size
+        view = memoryview(self._mmap)[HEADER_SIZE:]
+        begin = (oldest + first) % self.capacity
+        stop = begin + last - first
+        if stop <= self.capacity:
+            return [view[begin * size:stop * size]]
+        return [view[begin * size:], view[:(stop - self.capacity) * size]]
+
+    def records(self, start=None, end=None):
+        '''
+        Iterate over (timestamp, *fields) tuples with start <= timestamp < end.
+        '''
+        for view in self.slice(start, end):
+            yield from self.record.iter_unpack(view)
+            view.release()
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+'''
+Serve the SPC API to local clients over a Unix domain socket.
+
+Every message is a 4 byte big endian length followed by a JSON object:
+
+    request  {"id": 1, "method": "read_all", "args": []}
+    response {"id": 1, "result": {...}}
+    error    {"id": 1, "error": {"type": "OSError", "errno": 121, "message": "..."}}
+
+One worker thread owns the bus and runs the calls in the order they come
+in. A read that is still queued or running serves every identical read
+that comes in meanwhile, unless a write was queued after it.
+
+    spc-rpc --socket /run/spc.sock
+
+    client = RPCClient('/run/spc.sock')
+    client.write_fan_power(50)
+    print(client.read_all())
+'''
+import argparse
+from concurrent.futures import Future
+import errno
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from .spc import SPC
+
+DEFAULT_SOCKET = '/run/spc.sock'
+LENGTH = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 1 << 20
+
+READ_METHODS = tuple(name for name in dir(SPC) if name.startswith('read_')) + ('is_ready', 'get_buzzer_volume')
+WRITE_METHODS = tuple(name for name in dir(SPC) if name.startswith('write_')) + ('set_buzzer_volume', )
+
+
+def send_message(sock, message):
+    data = json.dumps(message, separators=(',', ':')).encode()
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    '''
+    Return the next message, None when the peer closed the connection.
+    '''
+    header = _recv_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    size = LENGTH.unpack(header)[0]
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes is too large")
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def _error(e):
+    error = {'type': type(e).__name__, 'message': str(e)}
+    if isinstance(e, OSError):
+        error['type'] = 'OSError'
+        error['errno'] = e.errno
+        error['message'] = e.strerror or str(e)
+    return error
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class RPCServer():
+    '''
+    spc, SPC object
+    path, str, Unix socket path
+    mode, int, permissions of the socket file
+    '''
+    def __init__(self, spc, path=DEFAULT_SOCKET, mode=0o660, get_logger=None):
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.path = path
+        self.mode = mode
+        self.calls = 0
+        self.coalesced = 0
+        self._queue = queue.Queue()
+        self._pending_reads = {}
+        self._writes = 0
+        self._pending_lock = threading.Lock()
+        self._buzzer_lock = threading.Lock()
+        self._worker = None
+        self._server = None
+
+    def _run_worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, future, method, args = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(getattr(self.spc, method)(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            if key is not None:
+                with self._pending_lock:
+                    if self._pending_reads.get(key, (None, ))[0] is future:
+                        del self._pending_reads[key]
+
+    def submit(self, method, args=()):
+        '''
+        Queue a call on the bus worker, return a Future of its result.
+        '''
+        args = tuple(args)
+        if method in READ_METHODS:
+            key = (method, args)
+            with self._pending_lock:
+                self.calls += 1
+                pending = self._pending_reads.get(key)
+                if pending is not None and pending[1] == self._writes:
+                    self.coalesced += 1
+                    return pending[0]
+                future = Future()
+                self._pending_reads[key] = (future, self._writes)
+                self._queue.put((key, future, method, args))
+            return future
+        if method in WRITE_METHODS:
+            with self._pending_lock:
+                self.calls += 1
+                self._writes += 1
+                future = Future()
+                self._queue.put((None, future, method, args))
+            return future
+        raise ValueError(f"Unknown method {method}")
+
+    def call(self, method, args=()):
+        if method == 'buzzer_play_tone':
+            return self._buzzer_play_tone(*args)
+        return self.submit(method, args).result()
+
+    def _buzzer_play_tone(self, tone, duration):
+        # Sleeps on the connection thread, the bus stays free while the tone plays
+        if 'buzzer' not in self.spc.device.peripherals:
+            raise ValueError(f"Buzzer not supported for {self.spc.device.name}")
+        with self._buzzer_lock:
+            self.submit('write_buzzer_freq', (tone, )).result()
+            try:
+                time.sleep(duration)
+            finally:
+                self.submit('write_buzzer_freq', (0, )).result()
+
+    def _handler(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        request = recv_message(self.request)
+                    except (OSError, ValueError) as e:
+                        server.log.warning(f'RPC bad request: {e}')
+                        return
+                    if request is None:
+                        return
+                    if not isinstance(request, dict):
+                        response = {'id': None, 'error': _error(ValueError('Request must be a JSON object'))}
+                    else:
+                        response = {'id': request.get('id')}
+                        method = request.get('method')
+                        args = request.get('args', ())
+                        if not isinstance(method, str) or not isinstance(args, (list, tuple)):
+                            response['error'] = _error(ValueError('Request needs a string method and a list of args'))
+                        else:
+                            try:
+                                response['result'] = server.call(method, args)
+                            except Exception as e:
+                                response['error'] = _error(e)
+                    try:
+                        send_message(self.request, response)
+                    except OSError:
+                        return
+
+        return Handler
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except ConnectionRefusedError:
+            # Left over by a server that did not shut down cleanly
+            os.unlink(self.path)
+            return
+        except FileNotFoundError:
+            return
+        finally:
+            sock.close()
+        raise OSError(errno.EADDRINUSE, f"Another server is listening on {self.path}")
+
+    def _serve(self):
+        self._remove_stale_socket()
+        self._worker = threading.Thread(target=self._run_worker, name='spc-rpc-bus', daemon=True)
+        self._worker.start()
+        self._server = _UnixServer(self.path, self._handler())
+        os.chmod(self.path, self.mode)
+        self.log.info(f'SPC RPC serving on {self.path}')
+
+    def start(self):
+        '''
+        Start serving in background threads.
+        '''
+        self._serve()
+        threading.Thread(target=self._server.serve_forever, name='spc-rpc', daemon=True).start()
+
+    def _close(self):
+        self._server.server_close()
+        self._server = None
+        self._queue.put(None)
+        self._worker.join()
+        self._worker = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._close()
+
+    def serve_forever(self):
+        self._serve()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._close()
+
+
+class RPCClient():
+    '''
+    Client of RPCServer with the SPC API as methods. Safe to share between threads,
+    calls from several threads take turns on the connection.
+
+    path, str, Unix socket path
+    timeout, float, seconds to wait for a response
+    '''
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._sock.settimeout(timeout)
+        self._lock = threading.Lock()
+        self._id = 0
+
+    def call(self, method, *args):
+        with self._lock:
+            self._id += 1
+            send_message(self._sock, {'id': self._id, 'method': method, 'args': args})
+            response = recv_message(self._sock)
+        if response is None:
+            raise ConnectionError(f"Connection to {self.path} closed")
+        error = response.get('error')
+        if error is None:
+            return response.get('result')
+        if error['type'] == 'OSError':
+            raise OSError(error.get('errno'), error['message'])
+        if error['type'] == 'ValueError':
+            raise ValueError(error['message'])
+        raise RuntimeError(f"{error['type']}: {error['message']}")
+
+    def __getattr__(self, name):
+        if name in READ_METHODS or name in WRITE_METHODS or name == 'buzzer_play_tone':
+            return lambda *args: self.call(name, *args)
+        raise AttributeError(name)
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the SPC API over a Unix socket')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket path')
+    parser.add_argument('--mode', type=lambda mode: int(mode, 8), default=0o660, help='socket file permissions, octal')
+    parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    server = RPCServer(SPC(bus=args.bus), path=args.socket, mode=args.mode)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
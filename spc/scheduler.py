@@ -0,0 +1,173 @@
+import threading
+import time
+
+from .spc import SPC
+
+
+class AdaptiveScheduler():
+    '''
+    Poll groups of SPC fields at a rate that follows the power state.
+
+    Every group reads with one SPC method and has an interval for each
+    state. The state is taken from the latest read_all() result:
+
+    - FAST while running on battery, discharging harder than
+      discharge_current, or with a shutdown request pending
+    - SLOW while plugged in, not charging and at full_percentage, only after
+      slow_after consecutive samples, so a short plug in does not slow down
+    - NORMAL otherwise
+
+    scheduler = AdaptiveScheduler(spc, callback=lambda group, data: print(group, data))
+    scheduler.start()
+    print(scheduler.state, scheduler.rates())
+    '''
+    FAST = 'fast'
+    NORMAL = 'normal'
+    SLOW = 'slow'
+
+    # group: (SPC method, {state: interval in seconds})
+    DEFAULT_GROUPS = {
+        'power': ('read_all', {FAST: 0.5, NORMAL: 2.0, SLOW: 10.0}),
+        'status': ('read_extended', {FAST: 10.0, NORMAL: 30.0, SLOW: 120.0}),
+    }
+
+    def __init__(self, spc, groups=None, callback=None, discharge_current=-500, full_percentage=100, slow_after=3, get_logger=None):
+        '''
+        spc, SPC object
+        groups, dict, group: (SPC method name, {state: interval}), default DEFAULT_GROUPS
+        callback, function(group, data) called after every read
+        discharge_current, int, mA, battery current at or below it polls fast
+        full_percentage, int, battery percentage treated as fully charged
+        slow_after, int, consecutive slow samples before slowing down
+        '''
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.groups = dict(self.DEFAULT_GROUPS if groups is None else groups)
+        self.callback = callback
+        self.discharge_current = discharge_current
+        self.full_percentage = full_percentage
+        self.slow_after = slow_after
+        self.state = self.NORMAL
+        self._slow_count = 0
+        self._last_run = {}
+        self._next_run = {group: 0.0 for group in self.groups}
+        self._period = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def classify(self, data):
+        '''
+        Return the state a read_all() result asks for.
+        '''
+        if data.get('power_source') == SPC.BATTERY:
+            return self.FAST
+        if data.get('battery_current', 0) <= self.discharge_current:
+            return self.FAST
+        if data.get('shutdown_request', SPC.SHUTDOWN_REQUEST_NONE) != SPC.SHUTDOWN_REQUEST_NONE:
+            return self.FAST
+        if data.get('is_input_plugged_in') and not data.get('is_charging') \
+                and data.get('battery_percentage', 0) >= self.full_percentage:
+            return self.SLOW
+        return self.NORMAL
+
+    def interval(self, group):
+        return self.groups[group][1][self.state]
+
+    def _update_state(self, data):
+        state = self.classify(data)
+        if state == self.SLOW:
+            self._slow_count += 1
+            if self._slow_count < self.slow_after:
+                state = self.NORMAL if self.state == self.FAST else self.state
+        else:
+            self._slow_count = 0
+        if state == self.state:
+            return
+        self.log.debug(f'AdaptiveScheduler state {self.state} -> {state}')
+        self.state = state
+        # Bring scheduled reads forward when speeding up
+        for group, last_run in self._last_run.items():
+            self._next_run[group] = min(self._next_run[group], last_run + self.interval(group))
+
+    def run_group(self, group, now=None):
+        if now is None:
+            now = time.monotonic()
+        method = self.groups[group][0]
+        last_run = self._last_run.get(group)
+        if last_run is not None:
+            # Smoothed time between reads of the group
+            period = now - last_run
+            self._period[group] = period if group not in self._period else 0.8 * self._period[group] + 0.2 * period
+        self._last_run[group] = now
+        try:
+            data = getattr(self.spc, method)()
+        except OSError as e:
+            self.log.warning(f'AdaptiveScheduler {group} read error: {e}')
+            data = None
+        if data is not None and method == 'read_all':
+            self._update_state(data)
+        self._next_run[group] = now + self.interval(group)
+        if data is not None and self.callback is not None:
+            try:
+                self.callback(group, data)
+            except Exception as e:
+                self.log.error(f'AdaptiveScheduler callback error: {e}')
+        return data
+
+    def run_pending(self, now=None):
+        '''
+        Run the groups that are due, return the time of the next due group.
+        '''
+        if now is None:
+            now = time.monotonic()
+        for group in self.groups:
+            if self._next_run[group] <= now:
+                self.run_group(group, now)
+        return min(self._next_run.values())
+
+    def rate(self, group):
+        '''
+        Return the measured reads per second of group, None before its second read.
+        '''
+        period = self._period.get(group)
+        if not period:
+            return None
+        return 1 / period
+
+    def rates(self):
+        return {group: self.rate(group) for group in self.groups}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                next_run = self.run_pending()
+            except Exception as e:
+                # Keep polling, but do not spin on a group that keeps failing
+                self.log.error(f'AdaptiveScheduler error: {e}')
+                next_run = time.monotonic() + min(self.interval(group) for group in self.groups)
+            self._stop.wait(max(0, next_run - time.monotonic()))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='spc-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+'''
+Share read_all() snapshots between processes through shared memory.
+
+One publisher owns the SPC object and writes every snapshot into a shared
+memory segment. Readers in other processes get the latest snapshot without
+touching the bus, guarded by a sequence counter: the publisher makes it odd
+before writing and even after, a reader retries when it was odd or changed
+while reading.
+
+    spc-publisher --interval 0.5
+
+    reader = SnapshotReader()
+    timestamp, data = reader.read()
+'''
+import argparse
+import fcntl
+from multiprocessing import shared_memory
+import os
+import struct
+import time
+
+from .poller import Poller
+from .spc import SPC
+
+DEFAULT_NAME = 'spc'
+SHM_DIR = '/dev/shm'
+MAGIC = b'SPCS'
+VERSION = 1
+
+# magic, version, record size, record format, field names
+HEADER = struct.Struct('<4sHH64s384s')
+HEADER_SIZE = 512
+SEQUENCE = struct.Struct('<Q')
+RECORD_OFFSET = HEADER_SIZE + SEQUENCE.size
+
+# Segments published by this process
+_published = set()
+
+
+class SnapshotPublisher():
+    '''
+    Publish every spc.read_all() snapshot of a Poller to shared memory.
+
+    The publisher holds an flock on the segment while it runs, so a second
+    publisher of the same name refuses to start, and a segment left over by
+    a publisher that did not shut down cleanly is replaced.
+
+    spc, SPC object
+    name, str, shared memory segment name
+    interval, float, seconds between samples when started, unless poller is given
+    mode, int, permissions of the segment, readers map it read-write so they
+        need read and write permission
+    poller, Poller, publish the samples of this poller instead of polling on its own
+    '''
+    def __init__(self, spc, name=DEFAULT_NAME, interval=1.0, mode=0o660, poller=None, get_logger=None):
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        self.spc = spc
+        self.name = name
+        self.interval = interval
+        self.fields = tuple(field[0] for field in spc.read_all_fields)
+        self.format = '<d' + ''.join(field[-1] for field in spc.read_all_fields)
+        self.record = struct.Struct(self.format)
+        self.count = 0
+        self._sequence = 0
+        self._own_poller = poller is None
+        self.poller = Poller(spc, interval=interval, size=1, get_logger=get_logger) if poller is None else poller
+        self._remove_callback = None
+
+        size = RECORD_OFFSET + self.record.size
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            self._remove_stale(name)
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self._lock_fd = os.open(os.path.join(SHM_DIR, self._shm.name), os.O_RDONLY)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.fchmod(self._lock_fd, mode)
+        _published.add(name)
+        self._buf = self._shm.buf
+        SEQUENCE.pack_into(self._buf, HEADER_SIZE, 0)
+        HEADER.pack_into(self._buf, 0, MAGIC, VERSION, self.record.size,
+                         self.format.encode(), ','.join(self.fields).encode())
+
+    @staticmethod
+    def _remove_stale(name):
+        fd = os.open(os.path.join(SHM_DIR, name.lstrip('/')), os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise FileExistsError(f"Shared memory {name} is in use by a running publisher") from None
+            # Left over by a publisher that did not shut down cleanly
+            shared_memory.SharedMemory(name).unlink()
+        finally:
+            os.close(fd)
+
+    def publish(self, data, timestamp=None):
+        '''
+        Write a read_all() result to shared memory.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        values = [data[name] for name in self.fields]
+        self._sequence += 1
+        SEQUENCE.pack_into(self._buf, HEADER_SIZE, self._sequence)
+        self.record.pack_into(self._buf, RECORD_OFFSET, timestamp, *values)
+        self._sequence += 1
+        SEQUENCE.pack_into(self._buf, HEADER_SIZE, self._sequence)
+        self.count += 1
+
+    def poll(self):
+        self.publish(self.spc.read_all())
+
+    def _on_sample(self, timestamp, data):
+        self.publish(data, timestamp)
+
+    def start(self):
+        '''
+        Publish the poller samples, and start the poller if it is the publisher's own.
+        '''
+        if self._remove_callback is not None:
+            return
+        self._remove_callback = self.poller.add_callback(self._on_sample)
+        if self._own_poller:
+            self.poller.start()
+
+    def stop(self):
+        if self._remove_callback is None:
+            return
+        self._remove_callback()
+        self._remove_callback = None
+        if self._own_poller:
+            self.poller.stop()
+
+    def close(self):
+        '''
+        Stop and remove the shared memory segment.
+        '''
+        self.stop()
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+        os.close(self._lock_fd)
+        _published.discard(self.name)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SnapshotReader():
+    '''
+    Read the snapshots of a SnapshotPublisher, from any process.
+
+    name, str, shared memory segment name
+    '''
+    def __init__(self, name=DEFAULT_NAME):
+        self.name = name
+        self._shm = self._attach(name)
+        self._buf = self._shm.buf
+        magic, version, record_size, fmt, names = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Shared memory {name} is not an SPC snapshot")
+        self.format = fmt.rstrip(b'\0').decode()
+        self.fields = tuple(names.rstrip(b'\0').decode().split(','))
+        self.record = struct.Struct(self.format)
+
+    @staticmethod
+    def _attach(name):
+        try:
+            return shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the segment with the
+            # resource tracker, which would unlink it when this process exits
+            from multiprocessing import resource_tracker
+            shm = shared_memory.SharedMemory(name)
+            if name not in _published:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    def read_values(self, retries=100):
+        '''
+        Return (timestamp, *values) of the latest snapshot in field order,
+        None if nothing was published yet.
+        '''
+        for _ in range(retries):
+            before = SEQUENCE.unpack_from(self._buf, HEADER_SIZE)[0]
+            if before == 0:
+                return None
+            if before & 1:
+                continue
+            values = self.record.unpack_from(self._buf, RECORD_OFFSET)
+            if SEQUENCE.unpack_from(self._buf, HEADER_SIZE)[0] == before:
+                return values
+        raise BlockingIOError(f"Snapshot {self.name} kept changing while reading")
+
+    def read(self, retries=100):
+        '''
+        Return (timestamp, data) of the latest snapshot, data like read_all(),
+        None if nothing was published yet.
+        '''
+        values = self.read_values(retries)
+        if values is None:
+            return None
+        return values[0], dict(zip(self.fields, values[1:]))
+
+    def age(self):
+        '''
+        Return the seconds since the latest snapshot, None if nothing was published yet.
+        A growing age means the publisher stopped.
+        '''
+        values = self.read_values()
+        if values is None:
+            return None
+        return time.time() - values[0]
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish SPC data to shared memory')
+    parser.add_argument('--name', default=DEFAULT_NAME, help='shared memory segment name')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between samples')
+    parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+    parser.add_argument('--mode', type=lambda mode: int(mode, 8), default=0o660, help='shared memory permissions, octal')
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    publisher = SnapshotPublisher(SPC(bus=args.bus), name=args.name, interval=args.interval, mode=args.mode)
+    try:
+        publisher.start()
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+
+if __name__ == '__main__':
+    main()
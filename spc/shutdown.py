@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+'''
+Safe shutdown daemon.
+
+Watches the shutdown requests of the device and the battery thresholds,
+and shuts the system down after a grace period. It reads the bus rarely
+on external power and often on battery, see AdaptiveScheduler, and sleeps
+until the next read is due.
+
+    spc-shutdown --grace-period 30 --hook 'wall "Shutting down: $SPC_REASON"'
+    spc-shutdown --simulate
+'''
+import argparse
+import os
+import subprocess
+import threading
+import time
+
+from .scheduler import AdaptiveScheduler
+from .spc import SPC
+
+
+class ShutdownDaemon():
+    '''
+    Shut down on a device shutdown request, or on battery when the battery
+    percentage reaches the shutdown threshold.
+
+    Hooks are called as hook(event, reason, data) with event PENDING when a
+    shutdown is decided, CANCELLED when external power comes back during the
+    grace period and SHUTDOWN right before the shutdown command runs.
+
+    daemon = ShutdownDaemon(spc, hooks=[lambda event, reason, data: print(event, reason)])
+    daemon.run()
+    '''
+    PENDING = 'pending'
+    CANCELLED = 'cancelled'
+    SHUTDOWN = 'shutdown'
+
+    REASONS = {
+        SPC.SHUTDOWN_REQUEST_LOW_BATTERY: 'low_battery',
+        SPC.SHUTDOWN_REQUEST_BUTTON: 'button',
+        SPC.SHUTDOWN_REQUEST_LOW_BATTERY_VOLTAGE: 'low_battery_voltage',
+    }
+    REASON_BATTERY_PERCENTAGE = 'battery_percentage'
+
+    DEFAULT_COMMAND = ('shutdown', '-h', 'now')
+
+    # group: (SPC method, {state: interval in seconds}), settings first so the
+    # thresholds are known before the first power check
+    DEFAULT_GROUPS = {
+        'settings': ('read_extended', {
+            AdaptiveScheduler.FAST: 300.0,
+            AdaptiveScheduler.NORMAL: 300.0,
+            AdaptiveScheduler.SLOW: 300.0,
+        }),
+        'power': ('read_all', {
+            AdaptiveScheduler.FAST: 2.0,
+            AdaptiveScheduler.NORMAL: 10.0,
+            AdaptiveScheduler.SLOW: 30.0,
+        }),
+    }
+
+    def __init__(self, spc, hooks=(), command=DEFAULT_COMMAND, grace_period=30.0, groups=None,
+                 max_read_rate=1.0, power_off_margin=5, dry_run=False, get_logger=None):
+        '''
+        spc, SPC object
+        hooks, list of functions(event, reason, data)
+        command, list, shutdown command
+        grace_period, float, seconds between deciding and running the shutdown
+        groups, dict, reads and intervals, default DEFAULT_GROUPS, see AdaptiveScheduler,
+            read_all groups are checked for shutdown, read_extended groups update the thresholds
+        max_read_rate, float, bus reads per second the fastest intervals may add up to
+        power_off_margin, int, %, without a shutdown percentage shut down this much above
+            the power off percentage
+        dry_run, bool, log the shutdown command instead of running it
+        '''
+        if get_logger is None:
+            import logging
+            get_logger = logging.getLogger
+        self.log = get_logger(__name__)
+
+        groups = dict(self.DEFAULT_GROUPS if groups is None else groups)
+        if not any(method == 'read_all' for method, _ in groups.values()):
+            raise ValueError("No group reads read_all, the shutdown requests would not be watched")
+        fastest = sum(1 / intervals[AdaptiveScheduler.FAST] for _, intervals in groups.values())
+        if fastest > max_read_rate:
+            raise ValueError(f"Read intervals need {fastest:.2f} reads per second, over the budget of {max_read_rate}")
+
+        self.spc = spc
+        self.hooks = list(hooks)
+        self.command = list(command)
+        self.grace_period = grace_period
+        self.power_off_margin = power_off_margin
+        self.dry_run = dry_run
+        self.scheduler = AdaptiveScheduler(spc, groups=groups, callback=self._on_read, get_logger=get_logger)
+
+        self.threshold = None
+        self.reason = None
+        self.deadline = None
+        self.done = False
+        self._last_data = None
+        self.reads = 0
+        self.cpu_time = 0.0
+        self._started = None
+        self._stop = threading.Event()
+
+    def _update_threshold(self, data):
+        shutdown_percentage = data.get('shutdown_percentage')
+        power_off_percentage = data.get('power_off_percentage')
+        if shutdown_percentage is not None:
+            self.threshold = shutdown_percentage
+        elif power_off_percentage is not None:
+            self.threshold = power_off_percentage + self.power_off_margin
+
+    def check(self, data):
+        '''
+        Return the shutdown reason for a read_all() result, None if there is none.
+        '''
+        reason = self.REASONS.get(data.get('shutdown_request'))
+        if reason is not None:
+            return reason
+        if data.get('power_source') == SPC.BATTERY and self.threshold is not None \
+                and data.get('battery_percentage', 100) <= self.threshold:
+            return self.REASON_BATTERY_PERCENTAGE
+        return None
+
+    def _run_hooks(self, event, data):
+        for hook in self.hooks:
+            try:
+                hook(event, self.reason, data)
+            except Exception as e:
+                self.log.error(f'ShutdownDaemon hook error: {e}')
+
+    def _on_read(self, group, data):
+        self.reads += 1
+        method = self.scheduler.groups[group][0]
+        if method == 'read_extended':
+            self._update_threshold(data)
+        if method != 'read_all':
+            return
+        reason = self.check(data)
+        if self.deadline is None:
+            if reason is not None:
+                self.reason = reason
+                self.deadline = time.monotonic() + self.grace_period
+                self.log.warning(f'Shutdown in {self.grace_period:g} s: {reason}')
+                self._run_hooks(self.PENDING, data)
+        elif reason is None and self.reason != self.REASONS[SPC.SHUTDOWN_REQUEST_BUTTON]:
+            self.log.warning(f'Shutdown cancelled: {self.reason} cleared')
+            self._run_hooks(self.CANCELLED, data)
+            self.reason = None
+            self.deadline = None
+        self._last_data = data
+
+    def _shutdown(self):
+        self._run_hooks(self.SHUTDOWN, self._last_data)
+        self.done = True
+        if self.dry_run:
+            self.log.warning(f'Dry run, would run: {" ".join(self.command)}')
+            return
+        self.log.warning(f'Shutting down: {self.reason}')
+        subprocess.run(self.command, check=False)
+
+    def run(self):
+        '''
+        Watch until the shutdown ran or stop() is called.
+        '''
+        self._started = time.monotonic()
+        self._stop.clear()
+        cpu_start = time.thread_time()
+        try:
+            while not self._stop.is_set():
+                next_run = self.scheduler.run_pending()
+                if self.deadline is not None:
+                    if time.monotonic() >= self.deadline:
+                        self._shutdown()
+                        return
+                    next_run = min(next_run, self.deadline)
+                self._stop.wait(max(0, next_run - time.monotonic()))
+        finally:
+            self.cpu_time += time.thread_time() - cpu_start
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        '''
+        Return the bus reads and CPU time used since run() started.
+        '''
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        return {
+            'elapsed': elapsed,
+            'reads': self.reads,
+            'read_rate': self.reads / elapsed if elapsed else 0.0,
+            'cpu_time': self.cpu_time,
+            'cpu_fraction': self.cpu_time / elapsed if elapsed else 0.0,
+            'state': self.scheduler.state,
+        }
+
+
+def _shell_hook(command, log):
+    def hook(event, reason, data):
+        env = dict(os.environ, SPC_EVENT=event, SPC_REASON=reason or '')
+        try:
+            subprocess.run(command, shell=True, env=env, timeout=10, check=False)
+        except subprocess.TimeoutExpired:
+            log.warning(f'Hook timed out: {command}')
+    return hook
+
+
+def _simulate(args):
+    '''
+    Run the daemon against a simulated PiPower 5 that loses external power
+    and drains, then print the bus and CPU use.
+    '''
+    from .benchmark import RecordingSMBus
+    from .simulator import SimulatedSMBus
+
+    simulated = SimulatedSMBus(0x5C)
+    device = simulated.devices[0x5C]
+    bus = RecordingSMBus(simulated)
+    device.set('shutdown_percentage', 20)
+    device.set('battery_percentage', 30)
+    spc = SPC(smbus=bus)
+    bus.reset()
+    daemon = ShutdownDaemon(spc, grace_period=args.grace_period, dry_run=True,
+                            hooks=[lambda event, reason, data: print(f'hook: {event} {reason}')])
+
+    def scenario():
+        time.sleep(5)
+        print('scenario: external power lost')
+        device.set('power_source', SPC.BATTERY)
+        device.set('is_input_plugged_in', 0)
+        device.set('is_charging', 0)
+        device.set('battery_current', -1500)
+        while not daemon.done:
+            time.sleep(1)
+            device.set('battery_percentage', max(0, device.get('battery_percentage') - 1))
+
+    threading.Thread(target=scenario, daemon=True).start()
+    daemon.run()
+    stats = daemon.stats()
+    print(f"elapsed {stats['elapsed']:.1f} s, {stats['reads']} reads, {bus.transactions} bus transactions "
+          f"({bus.transactions / stats['elapsed']:.2f}/s), CPU {stats['cpu_time'] * 1000:.1f} ms "
+          f"({stats['cpu_fraction'] * 100:.3f} %)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shut down safely on SPC shutdown requests and low battery')
+    parser.add_argument('--bus', type=int, default=1, help='I2C bus number')
+    parser.add_argument('--grace-period', type=float, default=30.0, help='seconds between deciding and shutting down')
+    parser.add_argument('--hook', action='append', default=[], help='shell command run on every event, with SPC_EVENT and SPC_REASON set')
+    parser.add_argument('--command', default=' '.join(ShutdownDaemon.DEFAULT_COMMAND), help='shutdown command')
+    parser.add_argument('--dry-run', action='store_true', help='log the shutdown command instead of running it')
+    parser.add_argument('--simulate', action='store_true', help='run against a simulated device and print the bus and CPU use')
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    if args.simulate:
+        if args.grace_period == parser.get_default('grace_period'):
+            args.grace_period = 3.0
+        _simulate(args)
+        return
+
+    log = logging.getLogger(__name__)
+    daemon = ShutdownDaemon(SPC(bus=args.bus), hooks=[_shell_hook(hook, log) for hook in args.hook],
+                            command=args.command.split(), grace_period=args.grace_period, dry_run=args.dry_run)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
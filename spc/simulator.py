@@ -0,0 +1,240 @@
+import ctypes
+import errno
+import random
+import struct
+import time
+
+from .devices import Devices
+from .spc import SPC
+
+I2C_M_RD = 0x0001
+SMBUS_BLOCK_MAX = 32
+
+# name: (data buffer register, struct format), see spc_data_buffer_sheet.md
+FIELDS = {name: (reg, fmt.replace('?', 'B')) for name, reg, fmt in SPC.READ_ALL_FIELDS}
+FIELDS.update({
+    'default_on': (SPC.REG_READ_DEFAULT_ON, 'B'),
+    'board_id': (SPC.REG_BOARD_ID_H, '>H'),
+    'shutdown_percentage': (SPC.REG_READ_SHUTDOWN_PERCENTAGE, 'B'),
+    'power_off_percentage': (SPC.REG_READ_POWER_OFF_PERCENTAGE, 'B'),
+    'battery_ir': (SPC.REG_BAT_IR_L, 'H'),
+    'power_btn_state': (SPC.REG_PWR_BTN_STATE, 'B'),
+    'charge_max_current': (SPC.REG_CHARGE_MAX_CURRENT, 'B'),
+    'buzzer_volume': (SPC.REG_BUZZER_VOL, 'B'),
+})
+
+DEFAULT_VALUES = {
+    'input_voltage': 5100,
+    'input_current': 1200,
+    'output_voltage': 5050,
+    'output_current': 900,
+    'battery_voltage': 8100,
+    'battery_current': 300,
+    'battery_percentage': 80,
+    'battery_capacity': 2000,
+    'power_source': SPC.EXTERNAL_INPUT,
+    'is_input_plugged_in': 1,
+    'is_charging': 1,
+    'fan_power': 0,
+    'shutdown_request': SPC.SHUTDOWN_REQUEST_NONE,
+    'default_on': 0,
+    'shutdown_percentage': SPC.SHUTDOWM_PERCENTAGE_MIN,
+    'power_off_percentage': SPC.POWER_OFF_PERCENTAGE_MIN,
+    'buzzer_volume': 5,
+}
+
+SPC_READ_ALL_NAMES = [name for name, _, _ in SPC.READ_ALL_FIELDS]
+
+
+class SimulatedDevice():
+    '''
+    Register model of one SPC board, see spc_data_buffer_sheet.md
+
+    address, int, one of Devices.ADDRESS, selects the device profile
+    mode, str, 'normal' or 'esp32', default from the device profile
+    firmware_version, tuple, (major, minor, patch)
+    '''
+    def __init__(self, address, mode=None, firmware_version=(1, 0, 0)):
+        profile = Devices.DEVICES[address]
+        self.address = address
+        self.mode = mode or profile['mode']
+        self.peripherals = profile['peripherals']
+        self.data = bytearray(256)
+        self.settings = bytearray(256)
+        self.pointer = 0
+        self.buzzer_freq = 0
+
+        for name, value in DEFAULT_VALUES.items():
+            if name in self.peripherals or name not in SPC_READ_ALL_NAMES:
+                self.set(name, value)
+        self.set('board_id', profile.get('board_id', 0))
+        self.data[SPC.REG_READ_FIRMWARE_VERSION_MAJOR:SPC.REG_READ_FIRMWARE_VERSION_PATCH+1] = bytes(firmware_version)
+
+    def set(self, name, value):
+        reg, fmt = FIELDS[name]
+        if fmt[0] != '>':
+            fmt = '<' + fmt
+        struct.pack_into(fmt, self.data, reg, value)
+
+    def get(self, name):
+        reg, fmt = FIELDS[name]
+        if fmt[0] != '>':
+            fmt = '<' + fmt
+        return struct.unpack_from(fmt, self.data, reg)[0]
+
+    def read(self, reg, num):
+        data = bytes(self.data[reg:reg+num])
+        return data + bytes(num - len(data))
+
+    def write(self, reg, values):
+        for offset, value in enumerate(values):
+            self._write_setting(reg + offset, value & 0xFF)
+
+    def _write_setting(self, reg, value):
+        self.settings[reg] = value
+        if reg == SPC.REG_WRITE_FAN_POWER:
+            self.set('fan_power', min(value, 100))
+        elif reg == SPC.REG_WRITE_RTC_SETTING:
+            if value == 1:
+                start = SPC.REG_WRITE_RTC_YEAR
+                self.data[SPC.REG_READ_RTC_YEAR:SPC.REG_READ_RTC_MILLISECOND+1] = self.settings[start:start+7]
+        elif reg == SPC.REG_WRITE_SHUTDOWN_PERCENTAGE:
+            self.set('shutdown_percentage', value)
+        elif reg == SPC.REG_WRITE_POWER_OFF_PERCENTAGE:
+            self.set('power_off_percentage', value)
+        elif reg == SPC.REG_WRITE_CHARGE_SELECT:
+            self.set('charge_max_current', value)
+        elif reg == SPC.REG_WRITE_POWER_BTN_STATE:
+            self.set('power_btn_state', value)
+        elif reg in (SPC.REG_WRITE_BUZZER_FEQ_L, SPC.REG_WRITE_BUZZER_FEQ_H):
+            self.buzzer_freq = self.settings[SPC.REG_WRITE_BUZZER_FEQ_H] << 8 | self.settings[SPC.REG_WRITE_BUZZER_FEQ_L]
+        elif reg == SPC.REG_WRITE_BUZZER_VOL:
+            self.set('buzzer_volume', value)
+
+
+class SimulatedSMBus():
+    '''
+    In-memory stand in for smbus2.SMBus, to use SPC without an I2C adapter.
+
+    devices, SimulatedDevice or device addresses on the bus
+    latency, float, seconds added to every bus transaction
+    error_rate, float, 0-1, probability of a transaction to fail with OSError
+    error_errno, int, errno of injected errors
+    seed, random seed for error injection
+
+    spc = SPC(smbus=SimulatedSMBus(0x5C))
+    '''
+    def __init__(self, *devices, latency=0, error_rate=0, error_errno=errno.EREMOTEIO, seed=None):
+        self.devices = {}
+        for device in devices:
+            if not isinstance(device, SimulatedDevice):
+                device = SimulatedDevice(device)
+            self.devices[device.address] = device
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_errno = error_errno
+        self._random = random.Random(seed)
+        self._fail_next = []
+
+    def fail_next(self, count=1, error_errno=errno.EREMOTEIO):
+        '''
+        Make the next count transactions fail with error_errno
+        '''
+        self._fail_next.extend([error_errno] * count)
+
+    def _transaction(self, addr):
+        if self.latency:
+            time.sleep(self.latency)
+        if self._fail_next:
+            _errno = self._fail_next.pop(0)
+            raise OSError(_errno, f"Simulated error on 0x{addr:02X}")
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise OSError(self.error_errno, f"Simulated error on 0x{addr:02X}")
+        if addr not in self.devices:
+            raise OSError(errno.EREMOTEIO, f"No device at 0x{addr:02X}")
+        return self.devices[addr]
+
+    def _normal_device(self, addr):
+        device = self._transaction(addr)
+        if device.mode != 'normal':
+            raise OSError(errno.EIO, f"SMBus command not supported by device 0x{addr:02X}")
+        return device
+
+    def _receive(self, device, num):
+        data = device.read(device.pointer, num)
+        if device.mode == 'esp32':
+            device.pointer = (device.pointer + num) & 0xFF
+        return data
+
+    def _send(self, device, data):
+        if not data:
+            return
+        if device.mode == 'esp32':
+            cmd, payload = data[0], data[1:]
+            if cmd == 0x01 and len(payload) == 1:
+                device.pointer = payload[0]
+            elif cmd == 0x02 and len(payload) >= 1:
+                device.write(payload[0], payload[1:])
+            else:
+                raise OSError(errno.EIO, f"Unknown command 0x{cmd:02X} for device 0x{device.address:02X}")
+        else:
+            device.pointer = data[0]
+            device.write(data[0], data[1:])
+
+    def read_byte(self, i2c_addr, force=None):
+        device = self._transaction(i2c_addr)
+        return self._receive(device, 1)[0]
+
+    def write_byte(self, i2c_addr, value, force=None):
+        device = self._transaction(i2c_addr)
+        if device.mode == 'normal':
+            device.pointer = value
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        device = self._normal_device(i2c_addr)
+        return device.read(register, 1)[0]
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        device = self._normal_device(i2c_addr)
+        device.write(register, [value])
+
+    def read_word_data(self, i2c_addr, register, force=None):
+        device = self._normal_device(i2c_addr)
+        data = device.read(register, 2)
+        return data[1] << 8 | data[0]
+
+    def write_word_data(self, i2c_addr, register, value, force=None):
+        device = self._normal_device(i2c_addr)
+        device.write(register, [value & 0xFF, value >> 8])
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        if length > SMBUS_BLOCK_MAX:
+            raise ValueError("Desired block length over %d bytes" % SMBUS_BLOCK_MAX)
+        device = self._normal_device(i2c_addr)
+        return list(device.read(register, length))
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        if len(data) > SMBUS_BLOCK_MAX:
+            raise ValueError("Data length cannot exceed %d bytes" % SMBUS_BLOCK_MAX)
+        device = self._transaction(i2c_addr)
+        self._send(device, [register] + list(data))
+
+    def i2c_rdwr(self, *i2c_msgs):
+        device = self._transaction(i2c_msgs[0].addr)
+        for msg in i2c_msgs:
+            if msg.addr != device.address:
+                device = self._transaction(msg.addr)
+            if msg.flags & I2C_M_RD:
+                data = self._receive(device, msg.len)
+                ctypes.memmove(msg.buf, data, msg.len)
+            else:
+                self._send(device, list(bytes(msg)))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
-from .i2c import I2C
+from .i2c import I2C, BusStats
+from .reading import reading_type
 from .devices import Devices
+import json
+import struct
 import time
 
 # class SPC()
@@ -15,6 +18,29 @@ class SPC():
     SHUTDOWN_REQUEST_BUTTON = 2
     SHUTDOWN_REQUEST_LOW_BATTERY_VOLTAGE = 3
 
+    DISCOVERY_PROBE = 'probe'
+    DISCOVERY_SCAN = 'scan'
+
+    POWER_BTN_RELEASED = 0
+    POWER_BTN_SINGLE_CLICKED = 1
+    POWER_BTN_DOUBLE_CLICKED = 2
+    POWER_BTN_LONG_PRESSED_2S = 3
+    POWER_BTN_LONG_PRESSED_2S_RELEASED = 4
+    POWER_BTN_LONG_PRESSED_5S = 5
+    POWER_BTN_LONG_PRESSED_5S_RELEASED = 6
+
+    CHARGE_STATE_STANDBY = 0
+    CHARGE_STATE_TRICKLE = 1
+    CHARGE_STATE_CONSTANT_CURRENT = 2
+    CHARGE_STATE_CONSTANT_VOLTAGE = 3
+    CHARGE_STATE_WAITING_POWER_SOURCE = 4
+    CHARGE_STATE_FULLY_CHARGED = 5
+    CHARGE_STATE_TIMEOUT = 6
+
+    TYPE_C_STATE_NO_CABLE = 0
+    TYPE_C_STATE_CONNECTED = 1
+    TYPE_C_STATE_ERROR = 2
+
     SHUTDOWM_PERCENTAGE_MIN = 10
     POWER_OFF_PERCENTAGE_MIN = 5
 
@@ -38,6 +64,25 @@ class SPC():
     # REG_READ_BATTERY_1_VOLTAGE = 21
     # REG_READ_BATTERY_2_VOLTAGE = 23
 
+    # name, register, struct format, '?' is an u8 flag, True if it equals 1
+    READ_ALL_FIELDS = (
+        ('input_voltage', REG_READ_INPUT_VOLTAGE, 'H'),
+        ('input_current', REG_READ_INPUT_CURRENT, 'H'),
+        ('output_voltage', REG_READ_OUTPUT_VOLTAGE, 'H'),
+        ('output_current', REG_READ_OUTPUT_CURRENT, 'H'),
+        ('battery_voltage', REG_READ_BATTERY_VOLTAGE, 'H'),
+        ('battery_current', REG_READ_BATTERY_CURRENT, 'h'),
+        ('battery_percentage', REG_READ_BATTERY_PERCENTAGE, 'B'),
+        ('battery_capacity', REG_READ_BATTERY_CAPACITY, 'H'),
+        ('power_source', REG_READ_POWER_SOURCE, 'B'),
+        ('is_input_plugged_in', REG_READ_IS_INPUT_PLUGGED_IN, '?'),
+        ('is_charging', REG_READ_IS_CHARGING, '?'),
+        ('fan_power', REG_READ_FAN_POWER, 'B'),
+        ('shutdown_request', REG_READ_SHUTDOWN_REQUEST, 'B'),
+        # ('battery_1_voltage', REG_READ_BATTERY_1_VOLTAGE, 'H'),
+        # ('battery_2_voltage', REG_READ_BATTERY_2_VOLTAGE, 'H'),
+    )
+
     REG_READ_FIRMWARE_VERSION_MAJOR = 128
     REG_READ_FIRMWARE_VERSION_MINOR = 129
     REG_READ_FIRMWARE_VERSION_PATCH = 130
@@ -62,13 +107,50 @@ class SPC():
 
     REG_BAT_IR_L = 145
     REG_BAT_IR_H = 146
+    REG_BAT_MIDDLE_VOLTAGE_L = 147
+    REG_BAT_MIDDLE_VOLTAGE_H = 148
+    REG_BAT_REAL_VOLTAGE_L = 149
+    REG_BAT_REAL_VOLTAGE_H = 150
 
     REG_PWR_BTN_STATE = 154
 
     REG_CHARGE_MAX_CURRENT = 155  # N*100mA
 
+    REG_SELECT_PDO = 156
+    REG_CHARGE_STATE = 157
+    REG_IS_FAST_CHARGE = 158
+    REG_TYPE_C_STATE = 160
+    REG_TYPE_C_PDO = 161
+
     REG_BUZZER_VOL = 162
 
+    REG_READ_BOOT_VERSION_MAJOR = 173
+    REG_READ_BOOT_VERSION_MINOR = 174
+    REG_READ_BOOT_VERSION_PATCH = 175
+
+    # Registers 128 to 175 in one read, see read_extended
+    REG_READ_EXTENDED_START = REG_READ_FIRMWARE_VERSION_MAJOR
+    REG_READ_EXTENDED_LENGTH = 48
+    READ_EXTENDED_STRUCT = struct.Struct(
+        '<'
+        '3B'    # 128 firmware version
+        'B'     # 131 reset code
+        '7B'    # 132 rtc
+        'B'     # 139 default on
+        '2B'    # 140 board id, high byte first
+        'x'
+        '2B'    # 143 shutdown and power off percentage
+        'H'     # 145 battery IR
+        'H'     # 147 battery middle voltage
+        'H'     # 149 battery real voltage
+        '3x'
+        '5B'    # 154 power button state, max charge current, select PDO, charge state, is fast charge
+        'x'
+        '3B'    # 160 type C state, type C PDO, buzzer volume
+        '10x'
+        '3B'    # 173 boot version
+    )
+
     REG_WRITE_FAN_POWER = 0
     REG_WRITE_RTC_YEAR = 1
     REG_WRITE_RTC_MONTH = 2
@@ -86,62 +168,234 @@ class SPC():
     REG_WRITE_BUZZER_FEQ_H = 14
     REG_WRITE_BUZZER_VOL = 15
 
-    def __init__(self, get_logger=None):
+    # setting: (peripheral, write register, min, max, name in errors), None for no limit
+    SETTINGS = {
+        'fan_power': ('fan_power', REG_WRITE_FAN_POWER, 0, 100, 'Fan power'),
+        'shutdown_percentage': ('shutdown_percentage', REG_WRITE_SHUTDOWN_PERCENTAGE, SHUTDOWM_PERCENTAGE_MIN, 100, 'Shutdown percentage'),
+        'power_off_percentage': ('power_off_percentage', REG_WRITE_POWER_OFF_PERCENTAGE, POWER_OFF_PERCENTAGE_MIN, 100, 'Power off percentage'),
+        'buzzer_volume': ('buzzer', REG_WRITE_BUZZER_VOL, None, None, 'Buzzer'),
+    }
+
+    def __init__(self, get_logger=None, bus=1, address=None, discovery=DISCOVERY_PROBE, cache_file=None, smbus=None, cache_ttl=None, lock_file=None, retry=None, write_cache=False, bus_stats=False, backend=I2C.BACKEND_SMBUS2, esp32_combined=True):
+        '''
+        bus, int, I2C bus number
+        address, int, device address, skip discovery if given
+        discovery, str, DISCOVERY_PROBE to probe only Devices.ADDRESS, DISCOVERY_SCAN for a full bus scan
+        cache_file, str, path of a discovery cache file, None to disable
+        smbus, SMBus like object to use instead of opening the bus
+        cache_ttl, float, seconds the read_all data serves the individual read_* calls, None to disable
+        lock_file, str, lock the bus across processes with flock on this file, None for in-process locking only
+        retry, RetryPolicy, retry transient bus errors with a circuit breaker, None to raise them at once
+        write_cache, bool, skip setting writes of the value the device already has, see refresh_write_cache()
+        bus_stats, bool, count the bus calls, see bus_stats()
+        backend, str, I2C.BACKEND_SMBUS2 or I2C.BACKEND_I2C_DEV to open the bus with, unless smbus is given
+        esp32_combined, bool, read esp32 mode devices with one combined transfer, False for a
+            command write and a separate read, see I2C
+        '''
         if get_logger is None:
             import logging
             get_logger = logging.getLogger
         self.log = get_logger(__name__)
-
-        addresses = I2C.scan()
-        if not addresses:
-            raise IOError(f"SPC init error: I2C device not found")
-        elif len(addresses) > 0:
-            for addr in Devices.ADDRESS:
-                if addr in addresses:
-                    self.addr = addr
-                    break
-            else:
-                raise IOError(f"SPC init error: I2C device not found")
+        self._get_logger = get_logger
+
+        self.bus = bus
+        self.lock_file = lock_file
+        self.retry = retry
+        self.esp32_combined = esp32_combined
+        self._bus_stats = BusStats(get_logger=get_logger) if bus_stats else None
+        self.cache_ttl = cache_ttl
+        self._snapshot = None
+        self.write_cache = write_cache
+        self._settings = None
+        if smbus is None:
+            smbus = I2C.open_bus(bus, backend)
+        self._smbus = smbus
+
+        discovered = address is None
+        if discovered:
+            address = self._discover(discovery, cache_file)
+        self.addr = address
         self.device = Devices(self.addr)
-        self.i2c = I2C(self.addr, mode=self.device.mode)
-        if not self.i2c.is_ready():
+        self.i2c = I2C(self.addr, bus=self.bus, mode=self.device.mode, smbus=self._smbus, lock_file=self.lock_file, retry=self.retry, stats=self._bus_stats, esp32_combined=self.esp32_combined)
+        self.read_all_fields, self.read_all_struct = self.compile_fields(self.READ_ALL_FIELDS, self.device.peripherals)
+        self._read_all_names = tuple(name for name, _, _ in self.read_all_fields)
+        self._read_all_flags = tuple(name for name, _, fmt in self.read_all_fields if fmt == '?')
+        # read_reading() result type, a namedtuple of the read_all fields
+        self.Reading = reading_type(self.device.id, self.read_all_fields)
+        if not discovered and not self.i2c.is_ready():
             self.log.error(f'SPC init error: I2C device not found at address 0x{self.addr:02X}')
             self._is_ready = False
             return
         self.log.info(f'SPC detect device: {self.device.name} ({self.device.id})')
         self._is_ready = True
 
+    @staticmethod
+    def compile_fields(fields, peripherals, start=0):
+        '''
+        Build one struct for the fields a device supports.
+
+        fields, tuple of (name, register, struct format)
+        peripherals, names of the supported fields
+        start, register of the first byte of the buffer
+
+        Return the supported fields in register order and a struct.Struct
+        decoding them from a buffer read at start.
+        '''
+        supported = sorted((field for field in fields if field[0] in peripherals), key=lambda field: field[1])
+        fmt = '<'
+        offset = start
+        for name, reg, field_fmt in supported:
+            field_fmt = field_fmt.replace('?', 'B')
+            if reg > offset:
+                fmt += f'{reg - offset}x'
+            fmt += field_fmt
+            offset = reg + struct.calcsize('<' + field_fmt)
+        return tuple(supported), struct.Struct(fmt)
+
+    def _discover(self, discovery, cache_file):
+        if cache_file is not None:
+            addr = self._load_discovery_cache(cache_file)
+            if addr is not None and I2C.probe_address(self._smbus, addr) and self._confirm_board(addr):
+                self.log.debug(f'SPC discovery: use cached address 0x{addr:02X}')
+                return addr
+
+        busy = []
+        if discovery == self.DISCOVERY_PROBE:
+            addresses = I2C.probe(Devices.ADDRESS, self.bus, smbus=self._smbus, busy=busy)
+        elif discovery == self.DISCOVERY_SCAN:
+            addresses = I2C.scan(self.bus, smbus=self._smbus, busy=busy)
+        else:
+            raise ValueError(f"Unknown discovery mode: {discovery}")
+        for addr in busy:
+            if addr in Devices.ADDRESS:
+                self.log.warning(f'SPC discovery: address 0x{addr:02X} is busy, maybe claimed by a kernel driver')
+
+        for addr in Devices.ADDRESS:
+            if addr in addresses and self._confirm_board(addr):
+                break
+        else:
+            raise IOError(f"SPC init error: I2C device not found")
+
+        if cache_file is not None:
+            self._save_discovery_cache(cache_file, addr)
+        return addr
+
+    def _confirm_board(self, addr):
+        device = Devices.DEVICES[addr]
+        if 'board_id' not in device:
+            return True
+        self.i2c = I2C(addr, bus=self.bus, mode=device['mode'], smbus=self._smbus, lock_file=self.lock_file, retry=self.retry, stats=self._bus_stats, esp32_combined=self.esp32_combined)
+        return self._check_board_id(device, addr)
+
+    def _check_board_id(self, device, addr):
+        try:
+            board_id = self.read_board_id()
+        except OSError:
+            return False
+        if board_id != device['board_id']:
+            self.log.debug(f'SPC discovery: board id {board_id} at 0x{addr:02X} does not match {device["name"]}')
+            return False
+        return True
+
+    def confirm_board(self) -> bool:
+        '''
+        Check that the board at the address is the expected device, by its
+        board id if the device has one. Useful with address given, which skips
+        discovery and its check.
+        '''
+        device = Devices.DEVICES[self.addr]
+        if 'board_id' not in device:
+            return True
+        return self._check_board_id(device, self.addr)
+
+    def _load_discovery_cache(self, cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache['bus'] != self.bus or cache['address'] not in Devices.ADDRESS:
+                return None
+            return cache['address']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_discovery_cache(self, cache_file, addr):
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump({'bus': self.bus, 'address': addr}, f)
+        except OSError as e:
+            self.log.warning(f'SPC discovery: failed to write cache file {cache_file}: {e}')
+
     def is_ready(self):
         return self._is_ready
 
+    def bus_stats(self) -> dict:
+        '''
+        Return the bus usage counters: 'i2c' the calls, see BusStats.snapshot(),
+        None unless bus_stats is enabled, 'lock' the bus lock waits and 'retry'
+        the retry outcomes if a retry policy is set.
+        '''
+        return {
+            'i2c': None if self._bus_stats is None else self._bus_stats.snapshot(),
+            'lock': self.i2c.lock.stats(),
+            'retry': None if self.retry is None else self.retry.stats(),
+        }
+
+    def reset_bus_stats(self):
+        if self._bus_stats is not None:
+            self._bus_stats.reset()
+        self.i2c.lock.reset_stats()
+        if self.retry is not None:
+            self.retry.reset_stats()
+
+    def add_bus_hook(self, callback):
+        '''
+        Call callback(method, register, mode, size, seconds, error) after every
+        bus call, enables bus_stats. Return a function that removes the hook.
+        '''
+        if self._bus_stats is None:
+            self._bus_stats = self.i2c.stats = BusStats(get_logger=self._get_logger)
+        return self._bus_stats.add_hook(callback)
+
     def read_input_voltage(self) -> int:
         if 'input_voltage' not in self.device.peripherals:
             raise ValueError(f"Input voltage not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_INPUT_VOLTAGE, '<H')
         return self.i2c.read_word_data(self.REG_READ_INPUT_VOLTAGE)
 
     def read_input_current(self) -> int:
         if 'input_current' not in self.device.peripherals:
             raise ValueError(f"Input current not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_INPUT_CURRENT, '<H')
         return self.i2c.read_word_data(self.REG_READ_INPUT_CURRENT)
 
     def read_output_voltage(self) -> int:
         if 'output_voltage' not in self.device.peripherals:
             raise ValueError(f"Output voltage not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_OUTPUT_VOLTAGE, '<H')
         return self.i2c.read_word_data(self.REG_READ_OUTPUT_VOLTAGE)
 
     def read_output_current(self) -> int:
         if 'output_current' not in self.device.peripherals:
             raise ValueError(f"Output current not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_OUTPUT_CURRENT, '<H')
         return self.i2c.read_word_data(self.REG_READ_OUTPUT_CURRENT)
 
     def read_battery_voltage(self) -> int:
         if 'battery_voltage' not in self.device.peripherals:
             raise ValueError(f"Battery voltage not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_BATTERY_VOLTAGE, '<H')
         return self.i2c.read_word_data(self.REG_READ_BATTERY_VOLTAGE)
 
     def read_battery_current(self) -> int:
         if 'battery_current' not in self.device.peripherals:
             raise ValueError(f"Battery current not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_BATTERY_CURRENT, '<h')
         uint16_val = self.i2c.read_word_data(self.REG_READ_BATTERY_CURRENT)
         int16_val = uint16_val if uint16_val < 32768 else uint16_val - 65536
         return int16_val
@@ -149,11 +403,15 @@ class SPC():
     def read_battery_percentage(self) -> int:
         if 'battery_percentage' not in self.device.peripherals:
             raise ValueError(f"Battery percentage not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_BATTERY_PERCENTAGE, '<B')
         return self.i2c.read_byte_data(self.REG_READ_BATTERY_PERCENTAGE)
 
     def read_battery_capacity(self) -> int:
         if 'battery_capacity' not in self.device.peripherals:
             raise ValueError(f"Battery capacity not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_BATTERY_CAPACITY, '<H')
         return self.i2c.read_word_data(self.REG_READ_BATTERY_CAPACITY)
 
     # def read_battery_1_voltage(self) -> int:
@@ -169,26 +427,36 @@ class SPC():
     def read_power_source(self) -> int:
         if 'power_source' not in self.device.peripherals:
             raise ValueError(f"Power source not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_POWER_SOURCE, '<B')
         return self.i2c.read_byte_data(self.REG_READ_POWER_SOURCE)
 
     def read_is_input_plugged_in(self) -> int:
         if 'is_input_plugged_in' not in self.device.peripherals:
             raise ValueError(f"Input plugged in status not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_IS_INPUT_PLUGGED_IN, '<B')
         return self.i2c.read_byte_data(self.REG_READ_IS_INPUT_PLUGGED_IN)
 
     def read_is_charging(self) -> int:
         if 'is_charging' not in self.device.peripherals:
             raise ValueError(f"Charging status not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_IS_CHARGING, '<B')
         return self.i2c.read_byte_data(self.REG_READ_IS_CHARGING)
 
     def read_fan_power(self) -> int:
         if 'fan_power' not in self.device.peripherals:
             raise ValueError(f"Fan power not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_FAN_POWER, '<B')
         return self.i2c.read_byte_data(self.REG_READ_FAN_POWER)
 
     def read_shutdown_request(self) -> int:
         if 'shutdown_request' not in self.device.peripherals:
             raise ValueError(f"Shutdown request not supported for {self.device.name}")
+        if self.cache_ttl:
+            return self._read_cached(self.REG_READ_SHUTDOWN_REQUEST, '<B')
         return self.i2c.read_byte_data(self.REG_READ_SHUTDOWN_REQUEST)
 
     def read_firmware_version(self):
@@ -222,82 +490,180 @@ class SPC():
             raise ValueError(f"Power off percentage not supported for {self.device.name}")
         return self.i2c.read_byte_data(self.REG_READ_POWER_OFF_PERCENTAGE)
 
+    def read_power_btn_state(self) -> int:
+        return self.i2c.read_byte_data(self.REG_PWR_BTN_STATE)
+
     def read_buzzer_volume(self) -> int:
         if 'buzzer' not in self.device.peripherals:
             raise ValueError(f"Buzzer volume not supported for {self.device.name}")
         return self.i2c.read_byte_data(self.REG_BUZZER_VOL)
 
-    def _unpack_u16(self, data, reg):
-        return data[reg+1] << 8 | data[reg]
+    def read_extended(self) -> dict:
+        '''
+        Read registers 128 to 175 in as few block reads as the device allows,
+        fields of unsupported peripherals are left out like in read_all.
+        '''
+        result = self.i2c.read_range(self.REG_READ_EXTENDED_START, self.REG_READ_EXTENDED_LENGTH)
+        values = self.READ_EXTENDED_STRUCT.unpack(bytes(result))
+        data = {}
+        data['firmware_version'] = f"{values[0]}.{values[1]}.{values[2]}"
+        data['reset_code'] = values[3]
+        if 'rtc' in self.device.peripherals:
+            rtc = list(values[4:11])
+            rtc[6] = int(1000*rtc[6]/128) # 1/128 seconds to millisecond
+            data['rtc'] = rtc
+        if 'default_on' in self.device.peripherals:
+            data['default_on'] = values[11]
+        data['board_id'] = values[12] << 8 | values[13]
+        if 'shutdown_percentage' in self.device.peripherals:
+            data['shutdown_percentage'] = values[14]
+        if 'power_off_percentage' in self.device.peripherals:
+            data['power_off_percentage'] = values[15]
+        data['battery_ir'] = values[16]
+        data['battery_middle_voltage'] = values[17]
+        data['battery_real_voltage'] = values[18]
+        data['power_btn_state'] = values[19]
+        data['charge_max_current'] = values[20] * 100
+        data['select_pdo'] = values[21]
+        data['charge_state'] = values[22]
+        data['is_fast_charge'] = values[23] == 1
+        data['type_c_state'] = values[24]
+        data['type_c_pdo'] = values[25]
+        if 'buzzer' in self.device.peripherals:
+            data['buzzer_volume'] = values[26]
+        data['boot_version'] = f"{values[27]}.{values[28]}.{values[29]}"
+        return data
 
-    def _unpack_int16(self, data, reg):
-        uint16_val = self._unpack_u16(data, reg)
-        int16_val = uint16_val if uint16_val < 32768 else uint16_val - 65536
-        return int16_val
+    def _read_common(self):
+        result = self.i2c.read_block_buffer(self.REG_READ_START, self.REG_READ_COMMON_LENGTH)
+        if self.cache_ttl:
+            self._snapshot = (time.monotonic(), result)
+        return result
 
-    def read_all(self) -> dict:
-        result = self.i2c.read_block_data(self.REG_READ_START, self.REG_READ_COMMON_LENGTH)
-        data = {}
-        if 'input_voltage' in self.device.peripherals:
-            data['input_voltage'] = self._unpack_u16(result, self.REG_READ_INPUT_VOLTAGE)
-        if 'input_current' in self.device.peripherals:
-            data['input_current'] = self._unpack_u16(result, self.REG_READ_INPUT_CURRENT)
-        if 'output_voltage' in self.device.peripherals:
-            data['output_voltage'] = self._unpack_u16(result, self.REG_READ_OUTPUT_VOLTAGE)
-        if 'output_current' in self.device.peripherals:
-            data['output_current'] = self._unpack_u16(result, self.REG_READ_OUTPUT_CURRENT)
-        if 'battery_voltage' in self.device.peripherals:
-            data['battery_voltage'] = self._unpack_u16(result, self.REG_READ_BATTERY_VOLTAGE)
-        if 'battery_current' in self.device.peripherals:
-            data['battery_current'] = self._unpack_int16(result, self.REG_READ_BATTERY_CURRENT)
-        if 'battery_percentage' in self.device.peripherals:
-            data['battery_percentage'] = result[self.REG_READ_BATTERY_PERCENTAGE]
-        if 'battery_capacity' in self.device.peripherals:
-            data['battery_capacity'] = self._unpack_u16(result, self.REG_READ_BATTERY_CAPACITY)
-        if 'power_source' in self.device.peripherals:
-            data['power_source'] = result[self.REG_READ_POWER_SOURCE]
-        if 'is_input_plugged_in' in self.device.peripherals:
-            data['is_input_plugged_in'] = result[self.REG_READ_IS_INPUT_PLUGGED_IN] == 1
-        if 'is_charging' in self.device.peripherals:
-            data['is_charging'] = result[self.REG_READ_IS_CHARGING] == 1
-        if 'fan_power' in self.device.peripherals:
-            data['fan_power'] = result[self.REG_READ_FAN_POWER]
-        if 'shutdown_request' in self.device.peripherals:
-            data['shutdown_request'] = result[self.REG_READ_SHUTDOWN_REQUEST]
-        # if 'battery_1_voltage' in self.device.peripherals:
-        #     data['battery_1_voltage'] = self._unpack_u16(result, self.REG_READ_BATTERY_1_VOLTAGE)
-        # if 'battery_2_voltage' in self.device.peripherals:
-        #     data['battery_2_voltage'] = self._unpack_u16(result, self.REG_READ_BATTERY_2_VOLTAGE)
+    def _read_cached(self, reg, fmt):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot[0] > self.cache_ttl:
+            result = self._read_common()
+        else:
+            result = snapshot[1]
+        return struct.unpack_from(fmt, result, reg)[0]
+
+    def invalidate_cache(self):
+        '''
+        Drop the cached snapshot, the next cached read will read the bus again.
+        '''
+        self._snapshot = None
 
+    def _read_all_values(self):
+        if self.cache_ttl:
+            return self.read_all_struct.unpack_from(self._read_common())
+        # Decoded straight from the bus backend buffer
+        return self.i2c.read_block_buffer(self.REG_READ_START, self.REG_READ_COMMON_LENGTH, self.read_all_struct.unpack_from)
+
+    def read_all(self) -> dict:
+        data = dict(zip(self._read_all_names, self._read_all_values()))
+        for name in self._read_all_flags:
+            data[name] = data[name] == 1
         return data
 
-    def write_fan_power(self, power):
-        if 'fan_power' not in self.device.peripherals:
-            raise ValueError(f"Fan power not supported for {self.device.name}")
-        if power <= 0:
-            power = 0
-        elif power > 100:
-            power = 100
+    def read_reading(self):
+        '''
+        Read the same data as read_all(), as a spc.Reading namedtuple.
+        '''
+        return self.Reading.from_values(self._read_all_values())
+
+    def _setting_value(self, name, value):
+        peripheral, reg, low, high, label = self.SETTINGS[name]
+        if peripheral not in self.device.peripherals:
+            raise ValueError(f"{label} not supported for {self.device.name}")
+        if low is not None and value <= low:
+            value = low
+        elif high is not None and value > high:
+            value = high
+        return reg, value
+
+    def refresh_write_cache(self):
+        '''
+        Read the current settings back from the device into the write cache.
+        Needed if something else changes them, e.g. another process.
+        '''
+        settings = {}
+        extended = self.read_extended()
+        for name, (peripheral, reg, _, _, _) in self.SETTINGS.items():
+            if peripheral not in self.device.peripherals:
+                continue
+            if name == 'fan_power':
+                settings[reg] = self.i2c.read_byte_data(self.REG_READ_FAN_POWER)
+            else:
+                settings[reg] = extended[name]
+        self._settings = settings
+
+    def _changed(self, reg, value):
+        if not self.write_cache:
+            return True
+        if self._settings is None:
+            self.refresh_write_cache()
+        return self._settings.get(reg) != value
+
+    def _write_setting(self, name, value):
+        reg, value = self._setting_value(name, value)
+        if not self._changed(reg, value):
+            return
+        self._write_registers([(reg, value)])
+
+    def _write_registers(self, values):
+        # values, sorted (register, value) pairs, contiguous registers go in one block write
+        runs = []
+        for reg, value in values:
+            if runs and runs[-1][0] + len(runs[-1][1]) == reg:
+                runs[-1][1].append(value)
+            else:
+                runs.append((reg, [value]))
+        try:
+            for reg, data in runs:
+                if len(data) == 1:
+                    self.i2c.write_byte_data(reg, data[0])
+                else:
+                    self.i2c.write_block_data(reg, data)
+                if self._settings is not None:
+                    for offset, value in enumerate(data):
+                        self._settings[reg + offset] = value
+        except OSError:
+            # The device state is unknown now
+            self._settings = None
+            raise
+        finally:
+            self.invalidate_cache()
+        return len(runs)
+
+    def write_settings(self, fan_power=None, shutdown_percentage=None, power_off_percentage=None, buzzer_volume=None) -> int:
+        '''
+        Write several settings in as few transfers as possible, settings left
+        None are not written. Contiguous registers are written in one block
+        write, with write_cache unchanged values are skipped.
+
+        Return the number of bus transfers.
+        '''
+        settings = {
+            'fan_power': fan_power,
+            'shutdown_percentage': shutdown_percentage,
+            'power_off_percentage': power_off_percentage,
+            'buzzer_volume': buzzer_volume,
+        }
+        values = [self._setting_value(name, value) for name, value in settings.items() if value is not None]
+        values = sorted((reg, value) for reg, value in values if self._changed(reg, value))
+        if not values:
+            return 0
+        return self._write_registers(values)
 
-        self.i2c.write_byte_data(self.REG_WRITE_FAN_POWER, power)
+    def write_fan_power(self, power):
+        self._write_setting('fan_power', power)
 
     def write_shutdown_percentage(self, percentage):
-        if 'shutdown_percentage' not in self.device.peripherals:
-            raise ValueError(f"Shutdown percentage not supported for {self.device.name}")
-        if percentage <= self.SHUTDOWM_PERCENTAGE_MIN:
-            percentage = self.SHUTDOWM_PERCENTAGE_MIN
-        elif percentage > 100:
-            percentage = 100
-        self.i2c.write_byte_data(self.REG_WRITE_SHUTDOWN_PERCENTAGE, percentage)
+        self._write_setting('shutdown_percentage', percentage)
 
     def write_power_off_percentage(self, percentage):
-        if 'power_off_percentage' not in self.device.peripherals:
-            raise ValueError(f"Power off percentage not supported for {self.device.name}")
-        if percentage <= self.POWER_OFF_PERCENTAGE_MIN:
-            percentage = self.POWER_OFF_PERCENTAGE_MIN
-        elif percentage > 100:
-            percentage = 100
-        self.i2c.write_byte_data(self.REG_WRITE_POWER_OFF_PERCENTAGE, percentage)
+        self._write_setting('power_off_percentage', percentage)
 
     def write_rtc(self, date:list):
         '''
@@ -307,16 +673,23 @@ class SPC():
             raise ValueError(f"RTC not supported for {self.device.name}")
         date.append(1)
         self.i2c.write_block_data(self.REG_WRITE_RTC_YEAR, date)
+        self.invalidate_cache()
+
+    def write_power_btn_state(self, state=POWER_BTN_RELEASED):
+        '''
+        state, int, write POWER_BTN_RELEASED to reset the latched button state
+        '''
+        self.i2c.write_byte_data(self.REG_WRITE_POWER_BTN_STATE, state)
+        self.invalidate_cache()
 
     def write_buzzer_volume(self, volume):
-        if 'buzzer' not in self.device.peripherals:
-            raise ValueError(f"Buzzer not supported for {self.device.name}")
-        self.i2c.write_byte_data(self.REG_WRITE_BUZZER_VOL, volume)
+        self._write_setting('buzzer_volume', volume)
 
     def write_buzzer_freq(self, tone):
         if 'buzzer' not in self.device.peripherals:
             raise ValueError(f"Buzzer not supported for {self.device.name}")
         self.i2c.write_word_data(self.REG_WRITE_BUZZER_FEQ_L, tone)
+        self.invalidate_cache()
 
     def buzzer_play_tone(self, tone, duration):
         '''